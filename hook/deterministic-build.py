@@ -2,11 +2,239 @@
 # -*- coding: utf-8 -*-
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
+import array
 import os
 import hashlib
-import re
+import json
+import mmap
 import struct
-from conans.util.files import md5sum
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+def md5sum(filename):
+    # the artifacts were just linked or patched, a cache of digests would never hit
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+ar_magic = b"!<arch>\n"
+ar_header_size = 60
+ar_date_offset = 16
+ar_date_size = 12
+ar_size_offset = 48
+ar_size_size = 10
+ar_zero_date = b"0".ljust(ar_date_size)
+# linker members and string tables of MSVC, GNU and BSD archives
+ar_special_members = ["/", "//", "/SYM64/", "__.SYMDEF", "__.SYMDEF SORTED",
+                      "__.SYMDEF_64", "__.SYMDEF_64 SORTED"]
+coff_machines = [0x14c, 0x8664, 0x1c0, 0x1c4, 0xaa64, 0x200]
+
+
+def ar_members(data):
+    """ Walks the member headers of an ar archive (MSVC .lib, GNU or BSD .a),
+    yields (name, header offset, data offset, data size)
+    """
+    if data[:len(ar_magic)] != ar_magic:
+        return
+    long_names = b""
+    pos = len(ar_magic)
+    while pos + ar_header_size <= len(data):
+        header = data[pos:pos + ar_header_size]
+        if header[58:60] != b"`\n":
+            return
+        raw_name = header[:16].rstrip(b" ")
+        size = int(header[ar_size_offset:ar_size_offset + ar_size_size].strip() or b"0")
+        offset = pos + ar_header_size
+        name_size = 0
+        if raw_name.startswith(b"#1/"):
+            # BSD: the name is stored before the member data
+            name_size = int(raw_name[3:])
+            name = data[offset:offset + name_size].rstrip(b"\x00")
+        elif raw_name.startswith(b"/") and raw_name[1:].isdigit():
+            # GNU and MSVC: offset in the long names member
+            start = int(raw_name[1:])
+            # GNU ends the names with "/\n", MSVC with a NUL
+            ends = [end for end in (long_names.find(b"\n", start), long_names.find(b"\x00", start))
+                    if end != -1]
+            name = long_names[start:min(ends) if ends else len(long_names)].rstrip(b"/")
+        elif raw_name in (b"/", b"//", b"/SYM64/"):
+            name = raw_name
+        else:
+            name = raw_name.rstrip(b"/")
+        if raw_name == b"//":
+            long_names = data[offset:offset + size]
+        yield name.decode("utf-8", "replace"), pos, offset + name_size, size - name_size
+        pos = offset + size + (size % 2)
+
+
+def coff_timestamp_offset(data, offset, size):
+    """ Offset of the TimeDateStamp of a COFF object, short import or anonymous
+    object member, None if the member is not one of them
+    """
+    if size < 20:
+        return None
+    sig1, sig2 = struct.unpack_from("<HH", data, offset)
+    if sig1 == 0 and sig2 == 0xFFFF:
+        return offset + 8
+    if sig1 in coff_machines:
+        return offset + 4
+    return None
+
+
+def zero_archive_timestamps(data):
+    """ Zeroes the date of every member header and the TimeDateStamp of the COFF
+    members, returns the names of the members that were modified
+    """
+    patched = []
+    for name, header, offset, size in ar_members(data):
+        touched = False
+        date = header + ar_date_offset
+        if data[date:date + ar_date_size].strip(b" ") not in (b"", b"0"):
+            data[date:date + ar_date_size] = ar_zero_date
+            touched = True
+        if name not in ar_special_members:
+            timestamp = coff_timestamp_offset(data, offset, size)
+            if timestamp is not None and data[timestamp:timestamp + 4] != b"\x00" * 4:
+                data[timestamp:timestamp + 4] = b"\x00" * 4
+                touched = True
+        if touched:
+            patched.append(name)
+    return patched
+
+
+pe_checksum_offset = 64
+pe_debug_entry_size = 28
+pe_debug_type_codeview = 2
+
+
+def _pe_sections(data, sections_offset, number_of_sections):
+    sections = []
+    for index in range(number_of_sections):
+        virtual_size, virtual_address, raw_size, raw_pointer = struct.unpack_from(
+            "<IIII", data, sections_offset + index * 40 + 8)
+        sections.append((virtual_address, max(virtual_size, raw_size), raw_pointer))
+    return sections
+
+
+def _pe_rva_to_offset(sections, rva):
+    for virtual_address, size, raw_pointer in sections:
+        if virtual_address <= rva < virtual_address + size:
+            return raw_pointer + rva - virtual_address
+    return None
+
+
+def pe_checksum(data, checksum_offset):
+    """ Checksum of the PE optional header: sum of 16 bit words with the carry
+    folded, skipping the checksum field, plus the file size
+    """
+    size = len(data)
+    with memoryview(data) as view:
+        with view[:size - size % 2].cast("H") as words:
+            if sys.byteorder == "big":
+                words = array.array("H", words)
+                words.byteswap()
+            skipped = checksum_offset // 2
+            total = sum(words) - words[skipped] - words[skipped + 1]
+    if size % 2:
+        total += data[size - 1]
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return total + size
+
+
+PeLayout = namedtuple("PeLayout", ["coff", "optional", "directories", "number_of_directories",
+                                   "sections"])
+
+
+def pe_layout(data):
+    """ Offsets of the COFF header, optional header and data directories of a
+    PE image, with its number of directories and sections. None if data isn't
+    a PE image.
+    """
+    if len(data) < 0x40 or data[:2] != b"MZ":
+        return None
+    pe = struct.unpack_from("<I", data, 0x3C)[0]
+    if data[pe:pe + 4] != b"PE\x00\x00":
+        return None
+    coff = pe + 4
+    number_of_sections = struct.unpack_from("<H", data, coff + 2)[0]
+    size_of_optional_header = struct.unpack_from("<H", data, coff + 16)[0]
+    optional = coff + 20
+    magic = struct.unpack_from("<H", data, optional)[0]
+    directories = optional + (112 if magic == 0x20b else 96)
+    number_of_directories = struct.unpack_from("<I", data, directories - 4)[0]
+    sections = _pe_sections(data, optional + size_of_optional_header, number_of_sections)
+    return PeLayout(coff, optional, directories, number_of_directories, sections)
+
+
+def pe_directory(data, layout, index):
+    """ File offset and size of a data directory, None and 0 if it is empty """
+    if index >= layout.number_of_directories:
+        return None, 0
+    rva, size = struct.unpack_from("<II", data, layout.directories + index * 8)
+    if not rva:
+        return None, 0
+    return _pe_rva_to_offset(layout.sections, rva), size
+
+
+def pe_debug_entries(data, layout):
+    """ Yields the offset of every entry of the debug directory and the offset
+    of the CodeView RSDS record it points to, None if it isn't one
+    """
+    debug, debug_size = pe_directory(data, layout, 6)
+    if debug is None:
+        return
+    for entry in range(debug, debug + debug_size, pe_debug_entry_size):
+        debug_type, _, _, raw_pointer = struct.unpack_from("<IIII", data, entry + 12)
+        is_codeview = debug_type == pe_debug_type_codeview and \
+            data[raw_pointer:raw_pointer + 4] == b"RSDS"
+        yield entry, raw_pointer if is_codeview else None
+
+
+def normalize_pe(data):
+    """ Zeroes the timestamps of a PE image (COFF header, export, resource and
+    debug directories) and the PDB GUID and age, then updates the checksum.
+    Returns the names of the modified fields.
+    """
+    patched = []
+
+    def _zero(offset, size, name):
+        if offset is not None and data[offset:offset + size] != b"\x00" * size:
+            data[offset:offset + size] = b"\x00" * size
+            patched.append(name)
+
+    layout = pe_layout(data)
+    if layout is None:
+        return patched
+
+    _zero(layout.coff + 4, 4, "COFF header TimeDateStamp")
+    export, _ = pe_directory(data, layout, 0)
+    if export is not None:
+        _zero(export + 4, 4, "export directory TimeDateStamp")
+    resource, _ = pe_directory(data, layout, 2)
+    if resource is not None:
+        _zero(resource + 4, 4, "resource directory TimeDateStamp")
+    for entry, codeview in pe_debug_entries(data, layout):
+        _zero(entry + 4, 4, "debug directory TimeDateStamp")
+        if codeview is not None:
+            _zero(codeview + 4, 16, "PDB GUID")
+            _zero(codeview + 20, 4, "PDB age")
+
+    checksum_offset = layout.optional + pe_checksum_offset
+    checksum = struct.pack("<I", pe_checksum(data, checksum_offset))
+    if data[checksum_offset:checksum_offset + 4] != checksum:
+        data[checksum_offset:checksum_offset + 4] = checksum
+        patched.append("checksum")
+    return patched
+
+
+# folders of the build tree that never contain artifacts to patch
+pruned_folders = ["CMakeFiles", ".cmake", ".git", "Testing"]
 
 
 class LibPatcher(object):
@@ -52,61 +280,107 @@ class LibPatcher(object):
         elif self._os == "Macos":
             del os.environ["ZERO_AR_DATE"]
 
+    def query_cmake_file_api(self):
+        # asks CMake to describe the artifacts of the targets when configuring
+        query = os.path.join(self._conanfile.build_folder, ".cmake", "api", "v1", "query")
+        try:
+            if not os.path.exists(query):
+                os.makedirs(query)
+            open(os.path.join(query, "codemodel-v2"), "a").close()
+        except OSError:
+            pass
+
+    def _cmake_artifacts(self):
+        reply = os.path.join(self._conanfile.build_folder, ".cmake", "api", "v1", "reply")
+        if not os.path.isdir(reply):
+            return None
+        indexes = sorted(name for name in os.listdir(reply) if name.startswith("index-"))
+        if not indexes:
+            return None
+        with open(os.path.join(reply, indexes[-1])) as f:
+            index = json.load(f)
+        codemodel = index.get("reply", {}).get("codemodel-v2")
+        if not codemodel:
+            return None
+        with open(os.path.join(reply, codemodel["jsonFile"])) as f:
+            codemodel = json.load(f)
+        build_type = self._conanfile.settings.get_safe("build_type")
+        configurations = [configuration for configuration in codemodel["configurations"]
+                          if configuration["name"] in (build_type, "")]
+        artifacts = []
+        for configuration in configurations or codemodel["configurations"]:
+            for target in configuration["targets"]:
+                with open(os.path.join(reply, target["jsonFile"])) as f:
+                    target = json.load(f)
+                for artifact in target.get("artifacts", []):
+                    artifacts.append(os.path.join(self._conanfile.build_folder, artifact["path"]))
+        return [artifact for artifact in artifacts if os.path.isfile(artifact)]
+
+    def _scan_artifacts(self, suffixes):
+        artifacts = []
+        folders = [self._conanfile.build_folder]
+        while folders:
+            for entry in os.scandir(folders.pop()):
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in pruned_folders:
+                        folders.append(entry.path)
+                elif entry.name.endswith(suffixes):
+                    artifacts.append(entry.path)
+        return artifacts
+
+    def _artifacts(self, suffixes):
+        try:
+            artifacts = self._cmake_artifacts()
+        except (OSError, ValueError, KeyError):
+            artifacts = None
+        if artifacts is None:
+            return self._scan_artifacts(suffixes)
+        return [artifact for artifact in artifacts if artifact.endswith(suffixes)]
+
     def patch(self):
-        if self._os == "Windows":
-            if self._compiler == "Visual Studio":
-                for root, _, filenames in os.walk(self._conanfile.build_folder):
-                    for filename in filenames:
-                        filename = os.path.join(root, filename)
-                        if ".lib" in filename and not self._conanfile.options.shared:
-                            self._patch_lib(filename)
-                        if "CMake" not in filename:
-                            if ".exe" in filename or ".dll" in filename:
-                                self._patch_pe(filename)
+        patchers = {}
+        static = not self._conanfile.options.get_safe("shared")
+        if self._os in ["Linux", "Macos"] and static:
+            patchers[".a"] = self._patch_lib
+        if self._os == "Windows" and self._compiler == "Visual Studio":
+            if static:
+                patchers[".lib"] = self._patch_lib
+            patchers[".exe"] = self._patch_pe
+            patchers[".dll"] = self._patch_pe
+        if not patchers:
+            return
+        artifacts = self._artifacts(tuple(patchers))
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(lambda artifact: patchers[os.path.splitext(artifact)[1]](artifact),
+                              artifacts))
 
     def _patch_lib(self, filename):
-        self._output.info("Patching {} with md5sum: {}".format(filename,md5sum(filename)))
-        pos = 0
+        self._output.info("Patching {}".format(filename))
+        if os.path.getsize(filename) <= len(ar_magic):
+            return
         with open(filename, 'r+b') as f:
-            header_start = 8
-            timestamp_offset = 16
-            timestamp_size = 12
-            pos = header_start + timestamp_offset
-            f.seek(header_start + timestamp_offset)
-            bytes = f.read(timestamp_size)
-            pos = pos + timestamp_size
-            pattern = bytes
-            regex = re.compile(pattern)
-            f.seek(0)
-            data = f.read()
-            for match_obj in regex.finditer(data):
-                offset = match_obj.start()
-                f.seek(offset)
-                f.write(b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00")
-                self._output.info(
-                    "patching timestamp at pos: {}".format(offset))
-
-            timestamp_str = bytes.decode("utf-8")
-            timestamp_int = int(timestamp_str)
-            timestamp_bytes = struct.pack("<I", timestamp_int)
-            regex = re.compile(timestamp_bytes)
-            f.seek(0)
-            data = f.read()
-            for match_obj in regex.finditer(data):
-                offset = match_obj.start()
-                f.seek(offset)
-                f.write(b"\x00\x00\x00\x00")
-                self._output.info(
-                    "patching timestamp at pos: {}".format(offset))
+            data = mmap.mmap(f.fileno(), 0)
+            try:
+                patched = zero_archive_timestamps(data)
+                data.flush()
+            finally:
+                data.close()
+        for member in patched:
+            self._output.info("patched timestamps of member: {}".format(member))
 
         self._output.info("Patched file: {} with md5sum: {}".format(filename,md5sum(filename)))
 
     def _patch_pe(self, filename):
-        patch_tool_location = "C:/ducible/ducible.exe"
-        if os.path.isfile(patch_tool_location):
-            self._output.info("Patching {} with md5sum: {}".format(filename,md5sum(filename)))
-            self._conanfile.run("{} {}".format(patch_tool_location, filename))
-            self._output.info("Patched file: {} with md5sum: {}".format(filename,md5sum(filename)))
+        self._output.info("Patching {}".format(filename))
+        with open(filename, 'r+b') as f:
+            data = mmap.mmap(f.fileno(), 0)
+            try:
+                patched = normalize_pe(data)
+                data.flush()
+            finally:
+                data.close()
+        self._output.info("Patched {} of {}".format(", ".join(patched) or "nothing", filename))
+        self._output.info("Patched file: {} with md5sum: {}".format(filename,md5sum(filename)))
 
 
 lib_patcher = LibPatcher()
@@ -115,6 +389,7 @@ lib_patcher = LibPatcher()
 def pre_build(output, conanfile, **kwargs):
     lib_patcher.init(output, conanfile)
     lib_patcher.set_environment()
+    lib_patcher.query_cmake_file_api()
 
 
 def post_build(output, conanfile, **kwargs):
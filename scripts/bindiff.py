@@ -0,0 +1,392 @@
+""" Localizes the differences between two builds of the same binary.
+
+The files are split in regions following their structure (ELF sections, PE
+and COFF sections, Mach-O sections, ar members recursively). Regions are
+compared by blocks of hashes and only the blocks that differ are compared
+byte by byte. Every difference is attributed to the symbol that contains it
+when the symbol table allows it and to a likely cause.
+"""
+import hashlib
+import importlib.util
+import os
+import re
+import struct
+import sys
+from collections import namedtuple
+
+
+def _load_hook():
+    # the archives are walked by the code of the hook, it is a single file to
+    # be installed in the Conan home, so it is loaded from its path
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hook",
+                        "deterministic-build.py")
+    spec = importlib.util.spec_from_file_location("deterministic_build", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+hook = _load_hook()
+
+block_size = 4096
+max_ranges = 8
+
+Region = namedtuple("Region", ["name", "offset", "size", "symbols"])
+Difference = namedtuple("Difference", ["region", "start", "end", "symbol", "cause"])
+
+TIMESTAMP = "timestamp"
+PDB_GUID = "timestamp (PDB GUID and age)"
+DATE_TIME = "__DATE__/__TIME__ string"
+BUILD_PATH = "build path (__FILE__ or debug info)"
+LTO_SEED = "LTO random seed"
+UNINITIALIZED = "uninitialized memory or padding"
+DEBUG_INFO = "debug info"
+UNKNOWN = "unknown"
+
+_data_sections = [".data", ".rodata", ".bss", ".tdata", ".tbss", ".rdata", "__data", "__const"]
+_date_time = re.compile(br"[A-Z][a-z]{2} [ \d]\d \d{4}|\d\d:\d\d:\d\d")
+# seconds from 1990 to 2100, values in this range are likely timestamps
+_timestamp_range = (631152000, 4102444800)
+
+
+def _cstring(data, offset):
+    end = data.find(b"\x00", offset)
+    return bytes(data[offset:end if end != -1 else len(data)]).decode("utf-8", "replace")
+
+
+def _elf_regions(data):
+    bits = data[4]
+    endian = "<" if data[5] == 1 else ">"
+    if bits == 2:
+        e_type, = struct.unpack_from(endian + "H", data, 16)
+        shoff, = struct.unpack_from(endian + "Q", data, 40)
+        ehsize, = struct.unpack_from(endian + "H", data, 52)
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 58)
+        section_format = endian + "IIQQQQIIQQ"
+    else:
+        e_type, = struct.unpack_from(endian + "H", data, 16)
+        shoff, = struct.unpack_from(endian + "I", data, 32)
+        ehsize, = struct.unpack_from(endian + "H", data, 40)
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", data, 46)
+        section_format = endian + "IIIIIIIIII"
+    sections = [struct.unpack_from(section_format, data, shoff + index * shentsize)
+                for index in range(shnum)]
+    if not sections:
+        return [Region("ELF header", 0, ehsize, None)]
+    names_offset = sections[shstrndx][4]
+    regions = [Region("ELF header", 0, ehsize, None),
+               Region("section headers", shoff, shnum * shentsize, None)]
+    by_index = {}
+    for index, (name, sh_type, _, addr, offset, size, link, _, _, entsize) in enumerate(sections):
+        if index == 0 or sh_type == 8:  # SHT_NOBITS has no contents in the file
+            continue
+        region = Region(_cstring(data, names_offset + name), offset, size, [])
+        by_index[index] = (region, addr)
+        regions.append(region)
+
+    # symbols are attributed to the sections that contain them
+    for index, (name, sh_type, _, _, offset, size, link, _, _, entsize) in enumerate(sections):
+        if sh_type != 2 or not entsize:  # SHT_SYMTAB
+            continue
+        strings = sections[link][4]
+        for entry in range(offset, offset + size, entsize):
+            if bits == 2:
+                st_name, _, _, st_shndx, st_value, st_size = struct.unpack_from(
+                    endian + "IBBHQQ", data, entry)
+            else:
+                st_name, st_value, st_size, _, _, st_shndx = struct.unpack_from(
+                    endian + "IIIBBH", data, entry)
+            if st_shndx not in by_index or not st_size:
+                continue
+            region, addr = by_index[st_shndx]
+            start = st_value if e_type == 1 else st_value - addr
+            region.symbols.append((start, start + st_size, _cstring(data, strings + st_name)))
+    return regions
+
+
+def _coff_sections(data, table, number, base_name=""):
+    regions = []
+    for index in range(number):
+        entry = table + index * 40
+        name = bytes(data[entry:entry + 8]).rstrip(b"\x00").decode("utf-8", "replace")
+        size, offset = struct.unpack_from("<II", data, entry + 16)
+        if offset and size:
+            regions.append(Region(base_name + name, offset, size, None))
+    return regions
+
+
+def _pe_regions(data):
+    pe, = struct.unpack_from("<I", data, 0x3C)
+    number, = struct.unpack_from("<H", data, pe + 6)
+    optional_size, = struct.unpack_from("<H", data, pe + 20)
+    table = pe + 24 + optional_size
+    return [Region("PE headers", 0, table + number * 40, None)] + \
+        _coff_sections(data, table, number)
+
+
+def _coff_regions(data):
+    number, = struct.unpack_from("<H", data, 2)
+    optional_size, = struct.unpack_from("<H", data, 16)
+    table = 20 + optional_size
+    return [Region("COFF header", 0, table + number * 40, None)] + \
+        _coff_sections(data, table, number)
+
+
+def _macho_regions(data):
+    magic, = struct.unpack_from("<I", data, 0)
+    bits64 = magic == 0xfeedfacf
+    header_size = 32 if bits64 else 28
+    ncmds, sizeofcmds = struct.unpack_from("<II", data, 16)
+    regions = [Region("Mach-O header and load commands", 0, header_size + sizeofcmds, None)]
+    offset = header_size
+    for _ in range(ncmds):
+        cmd, cmdsize = struct.unpack_from("<II", data, offset)
+        if cmd in (0x1, 0x19):  # LC_SEGMENT, LC_SEGMENT_64
+            nsects, = struct.unpack_from("<I", data, offset + (64 if bits64 else 48))
+            section = offset + (72 if bits64 else 56)
+            for _ in range(nsects):
+                sectname = _cstring(data[section:section + 16], 0)
+                segname = _cstring(data[section + 16:section + 32], 0)
+                if bits64:
+                    size, = struct.unpack_from("<Q", data, section + 40)
+                    file_offset, = struct.unpack_from("<I", data, section + 48)
+                    section += 80
+                else:
+                    size, file_offset = struct.unpack_from("<II", data, section + 36)
+                    section += 68
+                if file_offset and size:
+                    regions.append(Region("{},{}".format(segname, sectname), file_offset, size,
+                                          None))
+        offset += cmdsize
+    return regions
+
+
+def _ar_regions(data):
+    regions = []
+    for name, header, member_offset, member_size in hook.ar_members(data):
+        regions.append(Region("member {} header".format(name), header, member_offset - header,
+                              None))
+        member = data[member_offset:member_offset + member_size]
+        for region in regions_of(member):
+            regions.append(Region("member {}: {}".format(name, region.name),
+                                  member_offset + region.offset, region.size, region.symbols))
+    return regions
+
+
+def regions_of(data):
+    """ Regions of the file contents, a single one if the format is unknown """
+    try:
+        if data[:4] == b"\x7fELF":
+            regions = _elf_regions(data)
+        elif data[:8] == b"!<arch>\n":
+            regions = _ar_regions(data)
+        elif data[:2] == b"MZ":
+            regions = _pe_regions(data)
+        elif data[:4] in (b"\xcf\xfa\xed\xfe", b"\xce\xfa\xed\xfe"):
+            regions = _macho_regions(data)
+        elif len(data) >= 20 and struct.unpack_from("<H", data, 0)[0] in (0x14c, 0x8664, 0x1c4,
+                                                                          0xaa64):
+            regions = _coff_regions(data)
+        else:
+            regions = []
+    except (struct.error, IndexError, ValueError):
+        regions = []
+    return regions or [Region("contents", 0, len(data), None)]
+
+
+def _unique(regions):
+    result = {}
+    for region in regions:
+        name = region.name
+        count = 1
+        while name in result:
+            count += 1
+            name = "{} #{}".format(region.name, count)
+        result[name] = region
+    return result
+
+
+def block_digests(data, offset, size):
+    return [hashlib.blake2b(data[start:min(start + block_size, offset + size)],
+                            digest_size=8).digest()
+            for start in range(offset, offset + size, block_size)]
+
+
+def _differing_ranges(data_a, region_a, data_b, region_b):
+    """ Ranges relative to the start of the region where the contents differ """
+    size = min(region_a.size, region_b.size)
+    digests_a = block_digests(data_a, region_a.offset, size)
+    digests_b = block_digests(data_b, region_b.offset, size)
+    ranges = []
+    for block, (digest_a, digest_b) in enumerate(zip(digests_a, digests_b)):
+        if digest_a == digest_b:
+            continue
+        start = block * block_size
+        end = min(start + block_size, size)
+        a = data_a[region_a.offset + start:region_a.offset + end]
+        b = data_b[region_b.offset + start:region_b.offset + end]
+        position = 0
+        while position < len(a):
+            if a[position] == b[position]:
+                position += 1
+                continue
+            first = position
+            while position < len(a) and a[position] != b[position]:
+                position += 1
+            if ranges and ranges[-1][1] >= start + first - 4:
+                ranges[-1] = (ranges[-1][0], start + position)
+            else:
+                ranges.append((start + first, start + position))
+    if region_a.size != region_b.size:
+        ranges.append((size, max(region_a.size, region_b.size)))
+    return ranges
+
+
+def _context(data, start, end, spaces=True):
+    """ Printable string around the range, without spaces it is the word """
+    printable = lambda c: 33 <= c < 127 or (spaces and c == 32)
+    first = start
+    while first > 0 and start - first < 256 and printable(data[first - 1]):
+        first -= 1
+    last = end
+    while last < len(data) and last - end < 256 and printable(data[last]):
+        last += 1
+    return bytes(data[first:last])
+
+
+def _is_timestamp(data, start, end):
+    aligned = start - start % 4
+    for word in range(aligned, end, 4):
+        if word + 4 <= len(data):
+            value, = struct.unpack_from("<I", data, word)
+            if _timestamp_range[0] <= value <= _timestamp_range[1]:
+                return True
+    return False
+
+
+def classify(region_name, data_a, start_a, data_b, start_b, length):
+    """ Most likely cause of the difference of length bytes at the offsets """
+    end_a = start_a + length
+    end_b = start_b + length
+    context_a = _context(data_a, start_a, end_a)
+    context_b = _context(data_b, start_b, end_b)
+    word_a = _context(data_a, start_a, end_a, spaces=False)
+    word_b = _context(data_b, start_b, end_b, spaces=False)
+    if "lto" in region_name.lower() or any(b".lto_priv" in c or b"_GLOBAL__sub_I_" in c
+                                           for c in (context_a, context_b)):
+        return LTO_SEED
+    if "header" in region_name and "member" in region_name:
+        return TIMESTAMP
+    if any(len(c) > 3 and (b"/" in c or b"\\" in c) for c in (word_a, word_b)):
+        return BUILD_PATH
+    if any(_date_time.search(c) for c in (context_a, context_b)):
+        return DATE_TIME
+    if length <= 8 and _is_timestamp(data_a, start_a, end_a) and \
+            _is_timestamp(data_b, start_b, end_b):
+        return TIMESTAMP
+    section = region_name.split(": ")[-1]
+    if any(section.startswith(data_section) for data_section in _data_sections):
+        return UNINITIALIZED
+    if "debug" in section:
+        return DEBUG_INFO
+    return UNKNOWN
+
+
+def _pe_fields(data):
+    """ (start, end, cause) of the fields of a PE image that change in every
+    link, found the same way the hook finds them to zero them
+    """
+    try:
+        layout = hook.pe_layout(data)
+        if layout is None:
+            return []
+        fields = [(layout.coff + 4, layout.coff + 8, TIMESTAMP)]
+        for entry, codeview in hook.pe_debug_entries(data, layout):
+            fields.append((entry + 4, entry + 8, TIMESTAMP))
+            if codeview is not None:
+                fields.append((codeview + 4, codeview + 24, PDB_GUID))
+        return fields
+    except (struct.error, IndexError, ValueError):
+        return []
+
+
+def _field_cause(fields, start, end):
+    for first, last, cause in fields:
+        if first < end and start < last:
+            return cause
+    return None
+
+
+def _symbol(region, start):
+    for first, last, name in region.symbols or []:
+        if first <= start < last:
+            return name
+    return None
+
+
+def compare(data_a, data_b):
+    """ List of Difference between the contents of two builds """
+    regions_a = _unique(regions_of(data_a))
+    regions_b = _unique(regions_of(data_b))
+    fields = _pe_fields(data_a)
+    differences = []
+    for name, region_a in regions_a.items():
+        region_b = regions_b.get(name)
+        if region_b is None:
+            cause = LTO_SEED if ".gnu.lto" in name else UNKNOWN
+            differences.append(Difference(name + " (only in the first build)", 0, region_a.size,
+                                          None, cause))
+            continue
+        for start, end in _differing_ranges(data_a, region_a, data_b, region_b):
+            cause = _field_cause(fields, region_a.offset + start, region_a.offset + end) or \
+                classify(name, data_a, region_a.offset + start,
+                         data_b, region_b.offset + start, end - start)
+            differences.append(Difference(name, start, end, _symbol(region_a, start), cause))
+    for name, region_b in regions_b.items():
+        if name not in regions_a:
+            cause = LTO_SEED if ".gnu.lto" in name else UNKNOWN
+            differences.append(Difference(name + " (only in the second build)", 0, region_b.size,
+                                          None, cause))
+    return differences
+
+
+def compare_files(path_a, path_b):
+    with open(path_a, "rb") as f:
+        data_a = f.read()
+    with open(path_b, "rb") as f:
+        data_b = f.read()
+    return compare(data_a, data_b)
+
+
+def report(differences):
+    """ Lines describing the differences, grouped by region """
+    lines = []
+    by_region = {}
+    for difference in differences:
+        by_region.setdefault(difference.region, []).append(difference)
+    for region, region_differences in by_region.items():
+        causes = sorted(set(difference.cause for difference in region_differences))
+        lines.append("{}: {} differing ranges, likely {}".format(
+            region, len(region_differences), ", ".join(causes)))
+        for difference in region_differences[:max_ranges]:
+            symbol = " in {}".format(difference.symbol) if difference.symbol else ""
+            lines.append("    [0x{:x}-0x{:x}] {} bytes{}: {}".format(
+                difference.start, difference.end, difference.end - difference.start, symbol,
+                difference.cause))
+        if len(region_differences) > max_ranges:
+            lines.append("    ... {} more".format(len(region_differences) - max_ranges))
+    return lines
+
+
+def main(args):
+    if len(args) != 2:
+        print("usage: bindiff.py <binary> <binary>")
+        return 2
+    differences = compare_files(args[0], args[1])
+    for line in report(differences):
+        print(line)
+    return 1 if differences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,195 @@
+""" Declarative matrix of the determinism cases.
+
+A check set is the list of builds whose binaries must match. Every entry of
+the matrix combines a check set with the build types and hook states it runs
+with and an optional compiler gate, and is expanded to one case for each
+combination only when the cases are requested.
+"""
+import fnmatch
+import os
+from collections import namedtuple
+
+
+class Recipe(namedtuple("Recipe", ["folder", "cases", "main_source", "files"])):
+    """ files are the ones of the recipe folder that every build uses """
+    pass
+
+
+library = Recipe("../library", "../cases/lib", "src/mydetlib.cpp",
+                 ["conanfile.py", "include/mydetlib.hpp"])
+consumer = Recipe("../consumer", "../cases/consumer", "src/main.cpp", ["conanfile.py"])
+recipes = [library, consumer]
+
+
+def recipe_for(folder):
+    for recipe in recipes:
+        if os.path.normpath(recipe.folder) == os.path.normpath(folder):
+            return recipe
+    raise ValueError("Unknown recipe folder {}".format(folder))
+
+
+def check(recipe, source, cmakelists="CMakeLists.txt", user_channel=None, extra_sources=None):
+    sources = {
+        "{}/{}".format(recipe.cases, source): "{}/{}".format(recipe.folder, recipe.main_source),
+        "{}/{}".format(recipe.cases, cmakelists): "{}/CMakeLists.txt".format(recipe.folder)
+    }
+    for src, dst in (extra_sources or {}).items():
+        sources["{}/{}".format(recipe.cases, src)] = "{}/{}".format(recipe.folder, dst)
+    result = {"folder": recipe.folder, "sources": sources}
+    if user_channel:
+        result["user_channel"] = user_channel
+    return result
+
+
+def same_dir(recipe, source, cmakelists="CMakeLists.txt", **kwargs):
+    return [check(recipe, source, cmakelists, **kwargs),
+            check(recipe, source, cmakelists, **kwargs)]
+
+
+def two_dirs(recipe, source, cmakelists="CMakeLists.txt", **kwargs):
+    return [check(recipe, source, cmakelists, user_channel="user/channel1", **kwargs),
+            check(recipe, source, cmakelists, user_channel="user/channel2", **kwargs)]
+
+
+multiple_files = {
+    "sources0.cpp": "src/sources0.cpp",
+    "sources1.cpp": "src/sources1.cpp",
+    "sources2.cpp": "src/sources2.cpp",
+    "sources0.hpp": "include/sources0.hpp",
+    "sources1.hpp": "include/sources1.hpp",
+    "sources2.hpp": "include/sources2.hpp"
+}
+
+check_sets = {
+    "empty_lib": same_dir(library, "mydetlib_base.cpp"),
+    "empty_lib_2_dirs": two_dirs(library, "mydetlib_base.cpp"),
+    "empty_lib_debug_prefix_map": two_dirs(library, "mydetlib_base.cpp",
+                                           "CMakeListsDebugPrefix.txt"),
+    "empty_lib_macro_prefix_map": two_dirs(library, "mydetlib_base.cpp",
+                                           "CMakeListsMacroPrefix.txt"),
+    "empty_lib_file_prefix_map": two_dirs(library, "mydetlib_base.cpp",
+                                          "CMakeListsFilePrefix.txt"),
+    "date": same_dir(library, "mydetlib_macros_date.cpp"),
+    "time": same_dir(library, "mydetlib_macros_time.cpp"),
+    "file": same_dir(library, "mydetlib_macros_file.cpp"),
+    "file_2_dirs": two_dirs(library, "mydetlib_macros_file.cpp"),
+    "line": same_dir(library, "mydetlib_macros_line.cpp"),
+    "uninitialized": same_dir(library, "mydetlib_uninitialized.cpp"),
+    "initialized": same_dir(library, "mydetlib_initialized.cpp"),
+    "lto_flags": same_dir(library, "mydetlib_base.cpp", "CMakeListsLto.txt"),
+    "random_seed_fix_lto_flags": same_dir(library, "mydetlib_base.cpp", "CMakeListsFixLto.txt"),
+    "consumer_empty": same_dir(consumer, "main.cpp"),
+    "consumer_empty_brepro": same_dir(consumer, "main.cpp", "CMakeListsBrepro.txt"),
+    "empty_lib_brepro": same_dir(library, "mydetlib_base.cpp", "CMakeListsBrepro.txt"),
+    "lib_d1nodatetime": same_dir(library, "mydetlib_macros_date_time.cpp",
+                                 "CMakeListsd1nodatetime.txt"),
+    "consumer_d1nodatetime": same_dir(consumer, "mydetlib_macros_date_time.cpp",
+                                      "CMakeListsd1nodatetime.txt"),
+    "empty_lib_multiple_files_same_order": [
+        check(library, "multiple_files_lib.cpp", "CMakeListsMultipleFilesA.txt",
+              extra_sources=multiple_files),
+        check(library, "multiple_files_lib.cpp", "CMakeListsMultipleFilesA.txt",
+              extra_sources=multiple_files)
+    ],
+    "empty_lib_multiple_files_different_order": [
+        check(library, "multiple_files_lib.cpp", "CMakeListsMultipleFilesA.txt",
+              extra_sources=multiple_files),
+        check(library, "multiple_files_lib.cpp", "CMakeListsMultipleFilesB.txt",
+              extra_sources=multiple_files)
+    ]
+}
+
+# the library the consumer recipes require, as they reference it
+consumer_requirement = check_sets["empty_lib"][0]
+consumer_requirement_reference = "mydetlib/1.0@user/channel"
+
+
+def gcc(min_version=None):
+    def _gate(compiler, version):
+        return "gcc" in compiler and (min_version is None or int(version) >= min_version)
+    return _gate
+
+
+def msvc():
+    def _gate(compiler, version):
+        return "Visual Studio" in compiler
+    return _gate
+
+
+CaseSpec = namedtuple("CaseSpec", ["name", "check_set", "hook", "build_type", "shared"])
+
+
+class Entry(namedtuple("Entry", ["name", "check_set", "hooks", "build_types", "shared", "gate"])):
+    """ The name can use {build_type}, that is formatted for every build type """
+    def expand(self):
+        for build_type in self.build_types:
+            for hook in self.hooks:
+                yield CaseSpec(self.name.format(build_type=build_type), self.check_set,
+                               hook, build_type, self.shared)
+
+
+def entry(name, check_set, hooks=(False, True), build_types=("Release",), shared=False,
+          gate=None):
+    assert check_set in check_sets, check_set
+    return Entry(name, check_set, tuple(hooks), tuple(build_types), shared, gate)
+
+
+both = ("Release", "Debug")
+
+matrix = [
+    entry("Empty lib {build_type}", "empty_lib", build_types=both),
+    entry("Consumer Release", "consumer_empty", hooks=[False]),
+    entry("Empty lib {build_type}, 2 dirs", "empty_lib_2_dirs", build_types=both),
+    entry("Empty lib Debug, 2 dirs with Debug Fix", "empty_lib_debug_prefix_map", hooks=[True],
+          build_types=["Debug"]),
+    entry("Empty lib Debug, 2 dirs shared", "empty_lib_2_dirs", hooks=[False],
+          build_types=["Debug"], shared=True),
+    entry("Empty lib Multiple Files Same Order", "empty_lib_multiple_files_same_order",
+          hooks=[True]),
+    entry("Empty lib Multiple Files Different Order", "empty_lib_multiple_files_different_order",
+          hooks=[True]),
+    entry("Lib using __DATE__ macro", "date"),
+    entry("Lib using __TIME__ macro", "time"),
+    entry("Lib using __FILE__ macro", "file"),
+    entry("Lib using __FILE__ macro, 2 dirs", "file_2_dirs"),
+
+    entry("gcc: Use LTO flags", "lto_flags", gate=gcc()),
+    entry("gcc: Empty lib Fix LTO", "random_seed_fix_lto_flags", gate=gcc()),
+    entry("Lib using __FILE__ macro, 2 dirs Macro Fix", "empty_lib_macro_prefix_map",
+          hooks=[True], gate=gcc(8)),
+    entry("Lib using __FILE__ macro, Debug 2 dirs Macro Fix", "empty_lib_macro_prefix_map",
+          hooks=[True], build_types=["Debug"], gate=gcc(8)),
+    entry("Lib using __FILE__ macro, Debug 2 dirs File Fix", "empty_lib_file_prefix_map",
+          hooks=[True], build_types=["Debug"], gate=gcc(8)),
+
+    entry("msvc: Empty lib {build_type} with /Brepro", "empty_lib_brepro", hooks=[False],
+          build_types=both, gate=msvc()),
+    entry("msvc: Empty lib {build_type}", "empty_lib", hooks=[False], build_types=both,
+          gate=msvc()),
+    entry("msvc: Empty Consumer {build_type}", "consumer_empty", hooks=[False], build_types=both,
+          gate=msvc()),
+    entry("msvc: Empty Consumer {build_type} with /Brepro", "consumer_empty_brepro",
+          hooks=[False], build_types=both, gate=msvc()),
+    entry("msvc: Lib using __DATE__ and __TIME__ with d1nodatetime", "lib_d1nodatetime",
+          hooks=[False], gate=msvc()),
+    entry("msvc: Consumer using __DATE__ and __TIME__ with d1nodatetime",
+          "consumer_d1nodatetime", hooks=[False], gate=msvc())
+]
+
+
+def expand(compiler, version, patterns=None, hooks=None, build_types=None):
+    """ Generates the cases of the matrix enabled for the compiler, optionally
+    only the ones whose name matches any of the glob patterns, with the given
+    hook states or build types
+    """
+    for matrix_entry in matrix:
+        if matrix_entry.gate is not None and not matrix_entry.gate(compiler, version):
+            continue
+        for spec in matrix_entry.expand():
+            if patterns and not any(fnmatch.fnmatch(spec.name, pattern) for pattern in patterns):
+                continue
+            if hooks is not None and spec.hook not in hooks:
+                continue
+            if build_types and spec.build_type not in build_types:
+                continue
+            yield spec
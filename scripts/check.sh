@@ -4,3 +4,13 @@ set -e
 set -x
 
 python check_deterministic.py
+
+# a build killed by the timeout leaves the case unknown, it isn't a mismatch
+python check_deterministic.py --filter "Empty lib Release" --hook off --timeout 1 --no-memo \
+    --no-history --results-file logs/timeout.jsonl
+python -c "import json; assert all(json.loads(line)['success'] is None for line in open('logs/timeout.jsonl'))"
+
+# the repeated builds of a same dir case run at the same path, its debug info matches
+python check_deterministic.py --filter "Empty lib Debug" --hook on --repeat 3 --no-history \
+    --results-file logs/repeat.jsonl
+python -c "import json; assert all(json.loads(line)['success'] is True for line in open('logs/repeat.jsonl'))"
@@ -1,22 +1,42 @@
+import argparse
+import configparser
 import json
 import os
 import random
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed, wait)
 from datetime import datetime
 
 from colorama import Fore, Style, init
 
-
-def run(cmd, show=True):
+import bindiff
+import cases
+import chunks
+import objects
+import staging
+from conan_output import HOOK_MESSAGE, ConanOutputParser
+from conan_worker import CreateRequest, WorkerPool
+from digest import DigestCache, algorithms, default_cache_path, files_digests, package_digests
+from history import History, compare
+from memo import BuildMemo, build_fingerprint, changed_inputs, input_digests, inputs_fingerprint
+from reports import ResultsWriter
+from runner import RunResult, run_streaming
+
+
+def run(cmd, show=True, env=None):
     if show:
         print(cmd)
 
     result = ""
     try:
         result = subprocess.check_output(
-            cmd, shell=True, stderr=subprocess.STDOUT)
+            cmd, shell=True, stderr=subprocess.STDOUT, env=env)
     except subprocess.CalledProcessError as e:
         result = e.output
     return result
@@ -27,13 +47,6 @@ def load(filename):
         return f.read()
 
 
-def get_revision(console_txt):
-    console_txt = str(console_txt)
-    search_str = "Created package revision"
-    prev = console_txt.find(search_str)
-    return console_txt[prev+len(search_str)+1:-6]
-
-
 def get_compiler():
     compiler = ""
     version = ""
@@ -52,55 +65,82 @@ def get_compiler():
     return compiler, version
 
 
-def hook_output(console_txt):
-    for line in console_txt.splitlines():
-        if "HOOK - deterministic" in str(line):
-            print(Fore.CYAN + str(line, "utf-8") + Fore.RESET)
+def toolchain_versions(compiler):
+    """ First line of the version of the tools that build the packages. The
+    profile only has the major version of the compiler, an upgrade of the
+    compiler, the binutils or CMake must not reuse the results of the builds
+    with the old ones.
+    """
+    if "Visual Studio" in compiler:
+        # cl prints its version in the banner when it runs without arguments
+        tools = [["cl"]]
+    else:
+        cxx = os.environ.get("CXX") or ("clang++" if "clang" in compiler else "g++")
+        tools = [[cxx, "--version"], ["ar", "--version"],
+                 ["ld", "-v" if sys.platform == "darwin" else "--version"]]
+    tools.append(["cmake", "--version"])
+    versions = {}
+    for tool in tools:
+        try:
+            output = subprocess.run(tool, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    timeout=60).stdout.decode("utf-8", "replace").strip()
+        except (OSError, subprocess.SubprocessError):
+            output = None
+        versions[tool[0]] = output.splitlines()[0] if output else output
+    return versions
+
+
+_conan_workers = None
+
+
+def conan_workers():
+    """ Pool of Conan API workers of this process, they exit when it does """
+    global _conan_workers
+    if _conan_workers is None:
+        _conan_workers = WorkerPool()
+    return _conan_workers
+
+
+def run_conan_create(request, options, log_path=None, env=None):
+    """ Runs 'conan create' feeding its output to the parser as it is produced,
+    the hook messages are shown as soon as they arrive. With --api-workers it
+    runs in a Conan API worker, that also reports the package folder.
+    """
+    print(request.command())
+    parser = ConanOutputParser()
+
+    def _on_line(line):
+        for event in parser.feed(line):
+            if event.kind == HOOK_MESSAGE and not options.verbose:
+                print(Fore.CYAN + event.value + Fore.RESET)
+
+    if options.api_workers:
+        result, info = conan_workers().create(request, env, on_line=_on_line, log_path=log_path,
+                                              timeout=options.timeout, echo=options.verbose)
+        if info.get("package_folder"):
+            parser.package_folder = os.path.abspath(info["package_folder"])
+    else:
+        result = run_streaming(request.command(), _on_line, env=env, log_path=log_path,
+                               timeout=options.timeout, echo=options.verbose)
+    if result.timed_out:
+        print(Fore.RED + Style.BRIGHT + "Build timed out after {}s".format(options.timeout) +
+              Fore.RESET + Style.RESET_ALL)
+    print(Fore.BLUE + "Build {}".format(result) + Fore.RESET)
+    return parser, result
 
 
-def get_binary_names(console_txt):
-    paths = []
-    bin_files = []
-    package_folder = ""
-    for line in console_txt.splitlines():
-        binary_extensions = [".lib", ".exe", ".dll", ".a", ".so", ".dylib"]
-        line = str(line)
-        if any(extension in line for extension in binary_extensions):
-            if "Packaged" in line and "file:" in line:
-                bin_files.append(line[line.find("file:")+len("file:")+1:-1])
-            elif "Linking" in line and "library" in line:
-                bin_files.append(
-                    line[line.find("library")+len("library")+1:-1])
-        else:
-            if "Linking" in line and "executable" in line:
-                bin_files.append(line[line.find("bin")+len("bin")+1:-1])
-        if "Package folder" in line:
-            package_folder = os.path.abspath(
-                line[line.find("Package folder")+len("Package folder")+1:-1])
-
-    possible_subdirs = ["lib", "bin", "dll"]
-    for subdir in possible_subdirs:
-        for bin_file in bin_files:
-            path = os.path.join(package_folder, subdir, bin_file)
-            if os.path.isfile(path):
-                paths.append(path)
-    return list(set(paths))
-
-
-def get_binary_checksum(filename):
-    checksum = str(run("md5sum {}".format(filename), False))
-    return checksum[4:36]
-
-
-def activate_deterministic_hook(activate):
-    if activate:
-        run("conan config set hooks.deterministic-build", show=False)
-        print("\n" + Fore.MAGENTA + "DETERMINISTIC HOOK " +
-              Fore.CYAN + "ON" + Fore.RESET)
-    else:
-        run("conan config rm hooks.deterministic-build", show=False)
-        print("\n" + Fore.MAGENTA + "DETERMINISTIC HOOK " +
-              Fore.CYAN + "OFF" + Fore.RESET)
+def slugify(name):
+    return "".join(c if c.isalnum() else "_" for c in name).strip("_")
+
+
+def print_hook_state(activate):
+    print("\n" + Fore.MAGENTA + "DETERMINISTIC HOOK " +
+          Fore.CYAN + ("ON" if activate else "OFF") + Fore.RESET)
+
+
+def random_time_tuple():
+    return (random.randint(1998, 2018), random.randint(1, 12), 6, random.randint(0, 23),
+            random.randint(0, 59), 0, 0,)
 
 
 def set_system_rand_time():
@@ -119,87 +159,717 @@ def set_system_rand_time():
         subprocess.call(shlex.split("sudo hwclock -w"))
         print("System time faked: {}".format(datetime.now()))
 
-    time_tuple = (random.randint(1998, 2018), random.randint(
-        1, 12), 6, random.randint(0, 23), random.randint(0, 59), 0, 0,)
+    time_tuple = random_time_tuple()
     if os.environ.get('TRAVIS') == 'true':
         _linux_set_time(time_tuple)
     elif os.environ.get('APPVEYOR') == 'True' and sys.platform == 'win32':
         _win_set_time(time_tuple)
 
 
+faketime_libraries = ["/usr/lib/x86_64-linux-gnu/faketime/libfaketime.so.1",
+                      "/usr/lib/aarch64-linux-gnu/faketime/libfaketime.so.1",
+                      "/usr/lib/faketime/libfaketime.so.1",
+                      "/usr/lib64/faketime/libfaketime.so.1",
+                      "/usr/local/lib/faketime/libfaketime.1.dylib"]
+
+
+def find_faketime():
+    library = os.environ.get("FAKETIME_LIBRARY")
+    if library:
+        return library
+    for library in faketime_libraries:
+        if os.path.isfile(library):
+            return library
+    return None
+
+
+def virtual_clock_env(env=None):
+    """ Environment of a build that sees its own random time: SOURCE_DATE_EPOCH,
+    used by gcc and clang for __DATE__ and __TIME__, and libfaketime preloaded
+    in every process if it is installed, for the timestamps of the files.
+    """
+    env = dict(os.environ if env is None else env)
+    fake_time = datetime(*random_time_tuple())
+    env["SOURCE_DATE_EPOCH"] = str(int((fake_time - datetime(1970, 1, 1)).total_seconds()))
+    library = find_faketime()
+    if library is not None:
+        preload = "DYLD_INSERT_LIBRARIES" if sys.platform == "darwin" else "LD_PRELOAD"
+        env[preload] = os.pathsep.join(filter(None, [library, env.get(preload)]))
+        if sys.platform == "darwin":
+            env["DYLD_FORCE_FLAT_NAMESPACE"] = "1"
+        # the clock starts at the fake time in every process and advances.
+        # libfaketime reads it in the local time zone, in UTC it is the same
+        # instant as SOURCE_DATE_EPOCH, that gcc and clang show in UTC too
+        env["FAKETIME"] = fake_time.strftime("@%Y-%m-%d %H:%M:%S")
+        env["TZ"] = "UTC"
+    print("Virtual time: {}{}".format(fake_time, "" if library else " (SOURCE_DATE_EPOCH only)"))
+    return env
+
+
+def get_conan_home(env=None):
+    env = os.environ if env is None else env
+    user_home = env.get("CONAN_USER_HOME", os.path.expanduser("~"))
+    return os.path.join(user_home, ".conan")
+
+
+def _configured_storage(conan_home):
+    """ The [storage] path of the conan.conf of the Conan home, None if unset """
+    path = os.path.join(conan_home, "conan.conf")
+    if not os.path.isfile(path):
+        return None
+    parser = configparser.ConfigParser(allow_no_value=True, interpolation=None)
+    try:
+        parser.read(path)
+    except configparser.Error:
+        return None
+    return parser.get("storage", "path", fallback=None) or None
+
+
+def conan_storage(env=None):
+    """ Storage folder of the Conan cache of env, resolved like Conan 1.x does:
+    CONAN_STORAGE_PATH, then the [storage] path of conan.conf, relative to the
+    Conan home, then the data folder of the Conan home
+    """
+    env = os.environ if env is None else env
+    conan_home = get_conan_home(env)
+    path = env.get("CONAN_STORAGE_PATH") or _configured_storage(conan_home) or "data"
+    return os.path.abspath(os.path.join(conan_home, os.path.expanduser(path)))
+
+
+def isolated_env(user_home, env=None):
+    """ Environment of a temporary Conan home. Its storage is set explicitly,
+    the storage of the environment or of the copied conan.conf would be the one
+    of the user.
+    """
+    env = dict(os.environ if env is None else env)
+    env["CONAN_USER_HOME"] = user_home
+    env["CONAN_STORAGE_PATH"] = os.path.join(user_home, ".conan", "data")
+    return env
+
+
+def copy_conan_config(src_home, dst_home):
+    # only configuration is copied, the package data stays in the original cache
+    if not os.path.exists(dst_home):
+        os.makedirs(dst_home)
+    for filename in ["conan.conf", "settings.yml", "remotes.json", "registry.json", "registry.txt"]:
+        src = os.path.join(src_home, filename)
+        if os.path.isfile(src):
+            shutil.copy(src, dst_home)
+    for folder in ["profiles", "hooks"]:
+        src = os.path.join(src_home, folder)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(dst_home, folder))
+    hook = os.path.join(dst_home, "hooks", "deterministic-build.py")
+    if not os.path.isfile(hook):
+        if not os.path.exists(os.path.dirname(hook)):
+            os.makedirs(os.path.dirname(hook))
+        shutil.copy("../hook/deterministic-build.py", hook)
+
+
+def set_deterministic_hook(conan_home, activate):
+    """ Adds or removes the hook in the [hooks] section of the conan.conf of the
+    Conan home, like conan config set/rm would do but without running Conan
+    """
+    path = os.path.join(conan_home, "conan.conf")
+    lines = load(path).splitlines() if os.path.isfile(path) else []
+    result = []
+    section = None
+    has_hooks = False
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith("["):
+            if section == "hooks" and activate:
+                result.append("deterministic-build")
+            section = stripped.strip("[]")
+            has_hooks = has_hooks or section == "hooks"
+        elif section == "hooks" and stripped in ("deterministic-build",
+                                                 "deterministic-build.py"):
+            continue
+        result.append(line)
+    if activate and section == "hooks":
+        result.append("deterministic-build")
+    elif activate and not has_hooks:
+        result.extend(["[hooks]", "deterministic-build"])
+    with open(path, "w") as f:
+        f.write("\n".join(result) + "\n")
+
+
+_hook_overlays = {}
+_hook_overlays_lock = threading.Lock()
+
+
+def hook_env(activate, env=None):
+    """ Environment of the Conan processes of the builds with the hook on or
+    off. They use a copy of the configuration of the Conan home with the hook
+    set and share its cache, so the configuration of the user is never
+    modified and builds with the hook on and off can run at the same time.
+    """
+    env = dict(os.environ if env is None else env)
+    conan_home = get_conan_home(env)
+    # resolved before the overlay replaces the Conan home
+    storage = conan_storage(env)
+    with _hook_overlays_lock:
+        overlay = _hook_overlays.get((conan_home, activate))
+        if overlay is None:
+            overlay = tempfile.mkdtemp(prefix="dethook_")
+            copy_conan_config(conan_home, os.path.join(overlay, ".conan"))
+            set_deterministic_hook(os.path.join(overlay, ".conan"), activate)
+            _hook_overlays[(conan_home, activate)] = overlay
+    env["CONAN_USER_HOME"] = overlay
+    env["CONAN_STORAGE_PATH"] = storage
+    return env
+
+
+def remove_hook_overlays():
+    with _hook_overlays_lock:
+        for overlay in _hook_overlays.values():
+            shutil.rmtree(overlay, ignore_errors=True)
+        _hook_overlays.clear()
+
+
+def reference_folder(storage, reference):
+    """ Folder of the recipe and packages of name/version@user/channel in the cache """
+    name_version, user_channel = reference.split("@")
+    return os.path.join(storage, *(name_version.split("/") + user_channel.split("/")))
+
+
+# a variant of the consumer requirement created once for all the consumer
+# cases with its build type and hook state, folder is its copy in the cache
+PinnedRequirement = namedtuple("PinnedRequirement", ["reference", "folder", "package_revision"])
+
+
+def create_requirement(variant, user_home, base_conan_home, options):
+    """ Creates the consumer requirement with the (build type, hook state) of
+    variant in a Conan cache of its own. The consumer builds copy it to
+    their caches, so all of them link exactly this package revision.
+    """
+    build_type, hook_state = variant
+    conan_home = os.path.join(user_home, ".conan")
+    copy_conan_config(base_conan_home, conan_home)
+    set_deterministic_hook(conan_home, hook_state)
+    env = isolated_env(user_home)
+    reference = cases.consumer_requirement_reference
+    print("\n" + Fore.LIGHTMAGENTA_EX + "REQUIREMENT: {} ({}, hook {})".format(
+        reference, build_type, "on" if hook_state else "off") + Fore.RESET)
+    log_path = None
+    if options.log_dir:
+        if not os.path.exists(options.log_dir):
+            os.makedirs(options.log_dir)
+        log_path = os.path.join(options.log_dir, "requirement-{}-hook_{}.log".format(
+            build_type, "on" if hook_state else "off"))
+    requirement = cases.consumer_requirement
+    staged = staging.Staging.create(cases.recipe_for(requirement["folder"]),
+                                    requirement["sources"])
+    try:
+        request = CreateRequest(staged.resolve(requirement["folder"]), "user/channel",
+                                ["build_type={}".format(build_type)], [])
+        parser, result = run_conan_create(request, options, log_path, env=env)
+    finally:
+        staged.remove()
+    folder = reference_folder(conan_storage(env), reference)
+    if result.returncode != 0 or not os.path.isdir(folder):
+        print(Fore.RED + "The requirement could not be created, the consumer cases create "
+                         "their own" + Fore.RESET)
+        return None
+    return PinnedRequirement(reference, folder, parser.package_revision)
+
+
+# units are the objects of the build with --objects, before they were linked
+Build = namedtuple("Build", ["binaries", "run", "package_revision", "reused", "package_folder",
+                             "units"])
+CaseResult = namedtuple("CaseResult", ["hook_state", "success", "builds"])
+
+
+def stored_build(data):
+    """ Build from its json representation, stored in the memo or the history """
+    run_result = RunResult(*data["run"]) if data["run"] else None
+    units = [objects.Unit(*unit) for unit in data["units"]] if data.get("units") is not None \
+        else None
+    return Build([tuple(binary) for binary in data["binaries"]], run_result,
+                 data["package_revision"], True, data.get("package_folder"), units)
+
+
+def file_name(build, path):
+    """ Name a file is compared by: its path in the package or, if the package
+    folder is unknown, its file name
+    """
+    if build.package_folder and path.startswith(build.package_folder + os.sep):
+        return os.path.relpath(path, build.package_folder).replace(os.sep, "/")
+    return os.path.basename(path)
+
+
+def file_digests(build):
+    return {file_name(build, path): checksum for path, checksum in build.binaries}
+
+
 class Check(object):
-    def __init__(self, checks, build_type, shared):
+    def __init__(self, checks, build_type, shared, name=""):
         self._checks = checks
         self._build_type = build_type
         self._shared = shared
-
-    def check_library_determinism(self, hook_state):
-        activate_deterministic_hook(hook_state)
-        binary_checksums = {}
-        for check in self._checks:
-            # copy new source files
-            for src, dst in check["sources"].items():
-                path = os.path.dirname(dst)
-                if not os.path.exists(path):
-                    os.mkdir(path)
-                shutil.copy(src, dst)
-
-            folder = check["folder"]
-
-            if "user_channel" in check:
-                user_channel = check["user_channel"]
+        self._name = name
+        self._requirement_homes = set()
+        # the PinnedRequirement the consumer builds use, if it was created for them
+        self.requirement = None
+        self._snapshots = None
+        self._chunk_lists = {}
+
+    def _log_path(self, options, hook_state, label):
+        if not options.log_dir:
+            return None
+        if not os.path.exists(options.log_dir):
+            os.makedirs(options.log_dir)
+        filename = "{}-{}-hook_{}-{}.log".format(slugify(self._name), self._build_type,
+                                                  "on" if hook_state else "off", label)
+        return os.path.join(options.log_dir, filename)
+
+    @staticmethod
+    def _manifest(check):
+        return staging.manifest(cases.recipe_for(check["folder"]), check["sources"])
+
+    @staticmethod
+    def _is_consumer(check):
+        return cases.recipe_for(check["folder"]) == cases.consumer
+
+    def _create_consumer_requirement(self, options, hook_state, index, env=None):
+        """ Copies the pinned library the consumer requires to the Conan cache,
+        or creates it if there is none, once per cache, so the consumer never
+        links whatever library an earlier case left there
+        """
+        conan_home = get_conan_home(env)
+        if conan_home in self._requirement_homes:
+            return
+        self._requirement_homes.add(conan_home)
+        if self.requirement is not None:
+            folder = reference_folder(conan_storage(env), self.requirement.reference)
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
+            shutil.copytree(self.requirement.folder, folder, symlinks=True)
+            print("Pinned {} package revision {}".format(self.requirement.reference,
+                                                         self.requirement.package_revision))
+            return
+        requirement = cases.consumer_requirement
+        staged = staging.Staging.create(cases.recipe_for(requirement["folder"]),
+                                        requirement["sources"])
+        try:
+            request = CreateRequest(staged.resolve(requirement["folder"]), "user/channel",
+                                    ["build_type={}".format(self._build_type)], [])
+            run_conan_create(request, options,
+                             self._log_path(options, hook_state, "requirement{}".format(index)),
+                             env=env)
+        finally:
+            staged.remove()
+
+    def _fingerprint(self, check, options, hook_state, index, env=None):
+        conan_home = get_conan_home(env)
+        settings = [check.get("user_channel"), self._build_type, self._shared, hook_state,
+                    options.hash, options.clock, options.objects, options.chunks,
+                    options.toolchain, index]
+        files = [os.path.join(conan_home, "profiles", "default")]
+        if hook_state:
+            files.append(os.path.join(conan_home, "hooks", "deterministic-build.py"))
+        manifests = [self._manifest(check)]
+        if self._is_consumer(check):
+            manifests.append(self._manifest(cases.consumer_requirement))
+        return build_fingerprint(manifests, settings, files)
+
+    def inputs(self, hook_state, options, repeat=None):
+        """ Digests of the inputs of all the builds of the check, compared with
+        the ones of the last run by the incremental mode
+        """
+        conan_home = get_conan_home()
+        manifests = {}
+        for index, check in enumerate(self._checks):
+            manifests["check {}".format(index)] = self._manifest(check)
+            if self._is_consumer(check):
+                manifests["requirement"] = self._manifest(cases.consumer_requirement)
+        files = {"profile": os.path.join(conan_home, "profiles", "default")}
+        if hook_state:
+            files["hook"] = os.path.join(conan_home, "hooks", "deterministic-build.py")
+        settings = [[check.get("user_channel") for check in self._checks], self._build_type,
+                    self._shared, hook_state, options.hash, options.clock, options.toolchain,
+                    max(repeat or 0, len(self._checks))]
+        return input_digests(manifests, files, settings)
+
+    def _build(self, check, options, hook_state, index, env=None, use_memo=True):
+        """ Runs the build with index in the check, or reuses the result of a
+        previous build with the same inputs and index if the memo is enabled
+        """
+        memo = None
+        if use_memo and options.memo_file and not options.no_memo:
+            memo = BuildMemo(options.memo_file)
+            fingerprint = self._fingerprint(check, options, hook_state, index, env)
+            previous = memo.get(fingerprint)
+            if previous is not None:
+                memo.close()
+                print(Fore.BLUE + "Reusing the binaries of a previous build with the same inputs" +
+                      Fore.RESET)
+                build = stored_build(previous)
+                self._load_chunks(options, index, previous)
+                return build
+
+        if self._is_consumer(check):
+            self._create_consumer_requirement(options, hook_state, index, env)
+
+        if "user_channel" in check:
+            user_channel = check["user_channel"]
+        else:
+            user_channel = "user/channel"
+
+        package_options = ["shared=True"] if self._shared else []
+
+        staged = staging.Staging.create(cases.recipe_for(check["folder"]), check["sources"])
+        try:
+            create_env = env
+            if options.clock == "system":
+                set_system_rand_time()
+            elif options.clock == "virtual":
+                create_env = virtual_clock_env(env)
+            if options.objects:
+                create_env = dict(os.environ if create_env is None else create_env,
+                                  CMAKE_EXPORT_COMPILE_COMMANDS="ON")
+            request = CreateRequest(staged.resolve(check["folder"]), user_channel,
+                                    ["build_type={}".format(self._build_type)], package_options)
+            parser, result = run_conan_create(request, options,
+                                              self._log_path(options, hook_state, index),
+                                              env=create_env)
+        finally:
+            staged.remove()
+        package_folder = parser.package_folder
+        cache = None if options.no_digest_cache else DigestCache(default_cache_path())
+        try:
+            if package_folder is not None and os.path.isdir(package_folder):
+                # the whole package is compared, not only the binaries in the output
+                digests = package_digests(package_folder, options.hash, cache=cache,
+                                          use_manifest=not options.hash_packages)
+                binaries = [(os.path.join(package_folder, *name.split("/")), digest)
+                            for name, digest in sorted(digests.items())]
             else:
-                user_channel = "user/channel"
-
-            user_channel = user_channel + \
-                " -s build_type={}".format(self._build_type)
-            if self._shared:
-                user_channel = user_channel + "-o shared=True"
-
-            set_system_rand_time()
-            out = run(
-                "cd {} && conan create . {}".format(folder, user_channel))
-            bin_files = get_binary_names(out)
-            hook_output(out)
-            for bin_file_path in bin_files:
-                checksum = get_binary_checksum(bin_file_path)
-                #revision = get_revision(out)
-                bin_name = str(os.path.basename(bin_file_path))
-                print(Fore.YELLOW + Style.BRIGHT + "Created binary: " + bin_file_path +
-                      " with checksum " + checksum + Fore.RESET + Style.RESET_ALL)
-                if not bin_name in binary_checksums:
-                    binary_checksums[bin_name] = {
-                        "checksum": checksum, "fail": False}
-                elif checksum not in binary_checksums[bin_name]["checksum"]:
-                    print(Fore.RED + Style.BRIGHT +
-                          "binaries don't match!" + Fore.RESET + Style.RESET_ALL)
-                    binary_checksums[bin_name]["fail"] = True
-                else:
-                    print(Fore.GREEN + Style.BRIGHT +
-                          "binaries match!" + Fore.RESET + Style.RESET_ALL)
-                    binary_checksums[bin_name]["fail"] = False
-
-        for _, data in binary_checksums.items():
-            if data["fail"]:
-                return hook_state, False
+                package_folder = None
+                digests = files_digests(parser.binary_paths(), options.hash, cache=cache)
+                binaries = [(digest.path, digest.hexdigest) for digest in digests]
+        finally:
+            if cache is not None:
+                if cache.used:
+                    print("Digest cache: {}".format(cache.stats()))
+                cache.close()
+        units = None
+        if options.objects and parser.build_folder is not None and \
+                os.path.isdir(parser.build_folder):
+            units = objects.units(parser.build_folder, options.hash)
+            print("{} objects in {}".format(len(units), parser.build_folder))
+        build = Build(binaries, result, parser.package_revision, False, package_folder, units)
+        self._snapshot(index, build)
+        self._save_chunks(options, hook_state, index, build)
+        if memo is not None:
+            if build.binaries and result.returncode == 0:
+                record = build._asdict()
+                if options.chunks:
+                    record["chunks"] = {bin_name: [list(chunk) for chunk in chunk_list]
+                                        for bin_name, chunk_list in
+                                        self._chunk_lists[index].items()}
+                memo.put(fingerprint, record)
+            memo.close()
+        return build
+
+    def _snapshot(self, index, build):
+        """ Keeps the binaries of the build to diff them if they don't match, the
+        next build or the removal of its Conan cache would lose them
+        """
+        if self._snapshots is None:
+            return
+        folder = os.path.join(self._snapshots, str(index))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for path, _ in build.binaries:
+            snapshot = os.path.join(folder, file_name(build, path))
+            if not os.path.exists(os.path.dirname(snapshot)):
+                os.makedirs(os.path.dirname(snapshot))
+            shutil.copy2(path, snapshot)
+
+    def _chunks_path(self, options, hook_state, index, bin_name):
+        log_path = self._log_path(options, hook_state, index)
+        if log_path is None:
+            return None
+        return "{}-{}.chunks.json".format(os.path.splitext(log_path)[0],
+                                          bin_name.replace("/", "_"))
+
+    def _save_chunks(self, options, hook_state, index, build):
+        """ Chunk lists of the binaries, also written next to the log of the
+        build for chunks.py. The memo keeps them with the build.
+        """
+        if not options.chunks:
+            return
+        self._chunk_lists[index] = {}
+        for path, _ in build.binaries:
+            bin_name = file_name(build, path)
+            # a binary can be named *.json, it is never a saved chunk list here
+            with open(path, "rb") as f:
+                chunk_list = chunks.chunk_list(f.read())
+            self._chunk_lists[index][bin_name] = chunk_list
+            chunks_path = self._chunks_path(options, hook_state, index, bin_name)
+            if chunks_path is not None:
+                chunks.save(chunk_list, chunks_path)
+
+    def _load_chunks(self, options, index, record):
+        """ Chunk lists of a build reused from the memo, --chunks is part of the
+        fingerprint so the record has them
+        """
+        if not options.chunks:
+            return
+        self._chunk_lists[index] = {bin_name: [chunks.Chunk(*chunk) for chunk in chunk_list]
+                                    for bin_name, chunk_list in record.get("chunks", {}).items()}
+
+    def _print_chunk_ranges(self, bin_name, first_index, index):
+        first = self._chunk_lists.get(first_index, {}).get(bin_name)
+        second = self._chunk_lists.get(index, {}).get(bin_name)
+        if first is None or second is None:
+            return
+        print(Fore.RED + "Differing chunks of {}:".format(bin_name) + Fore.RESET)
+        for line in chunks.report(chunks.differing_ranges(first, second)):
+            print("    " + line)
+
+    def _print_diff(self, bin_name, first_index, index):
+        first = os.path.join(self._snapshots, str(first_index), bin_name)
+        second = os.path.join(self._snapshots, str(index), bin_name)
+        if not os.path.isfile(first) or not os.path.isfile(second):
+            # reused from the memo, the binaries of that build are gone
+            return
+        print(Fore.RED + "Differences of {}:".format(bin_name) + Fore.RESET)
+        for line in bindiff.report(bindiff.compare_files(first, second)):
+            print("    " + line)
+
+    @staticmethod
+    def _failed(build):
+        return build.run is not None and (build.run.returncode != 0 or build.run.timed_out)
+
+    @classmethod
+    def _mismatch(cls, builds):
+        """ True if the next builds aren't needed: a build failed or the
+        packages of two of them don't match
+        """
+        if any(cls._failed(build) for _, build in builds):
+            return True
+        packages = [set(file_digests(build).items()) for _, build in builds]
+        return any(package != packages[0] for package in packages[1:])
+
+    @staticmethod
+    def _folder_key(check):
+        # the builds of a recipe with the same user/channel use the same
+        # folders of a Conan cache
+        return check["folder"], check.get("user_channel")
+
+    def _build_concurrently(self, hook_state, options, count):
+        """ Runs the builds in different folders at the same time, in their own
+        Conan caches. The builds in the same folder, like the two sides of a
+        same dir check, run one after the other in the same cache, so their
+        paths are identical. The builds not started yet are skipped at the
+        first mismatch.
+        """
+        base_conan_home = get_conan_home()
+        print_hook_state(hook_state)
+        groups = {}
+        for index in range(count):
+            check = self._checks[index % len(self._checks)]
+            groups.setdefault(self._folder_key(check), []).append(index)
+        user_homes = [tempfile.mkdtemp(prefix="detbuild_") for _ in groups]
+        for user_home in user_homes:
+            copy_conan_config(base_conan_home, os.path.join(user_home, ".conan"))
+            set_deterministic_hook(os.path.join(user_home, ".conan"), hook_state)
+
+        builds = []
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def _build_group(user_home, indexes):
+            env = isolated_env(user_home)
+            for index in indexes:
+                if stop.is_set():
+                    return
+                build = self._build(self._checks[index % len(self._checks)], options, hook_state,
+                                    index, env, use_memo=count == len(self._checks))
+                with lock:
+                    builds.append((index, build))
+                    if self._mismatch(builds):
+                        stop.set()
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                futures = [executor.submit(_build_group, user_home, indexes)
+                           for user_home, indexes in zip(user_homes, groups.values())]
+                for future in futures:
+                    future.result()
+        finally:
+            for user_home in user_homes:
+                shutil.rmtree(user_home, ignore_errors=True)
+        return sorted(builds, key=lambda item: item[0])
+
+    def _build_serially(self, hook_state, options, count):
+        print_hook_state(hook_state)
+        env = hook_env(hook_state)
+        builds = []
+        for index in range(count):
+            build = self._build(self._checks[index % len(self._checks)], options, hook_state,
+                                index, env, use_memo=count == len(self._checks))
+            builds.append((index, build))
+            if self._mismatch(builds):
+                break
+        return builds
+
+    def check_library_determinism(self, hook_state, options=None, repeat=None):
+        """ Builds every check, or repeat builds going through the checks in
+        turn, and compares the binaries. Repeated builds are never reused from
+        the memo and stop at the first mismatch. They run one after the other in
+        the same Conan cache, like the checks, unless --concurrent-checks is set,
+        so the builds of a same dir check are at the same absolute path.
+        """
+        options = options or get_parser().parse_args([])
+        count = max(repeat or 0, len(self._checks))
+        if not options.no_diff:
+            self._snapshots = tempfile.mkdtemp(prefix="detsnapshots_")
+        self._chunk_lists = {}
+        try:
+            if options.concurrent_checks:
+                builds = self._build_concurrently(hook_state, options, count)
             else:
-                return hook_state, True
+                builds = self._build_serially(hook_state, options, count)
+            if count > len(self._checks):
+                print("{} of {} builds done".format(len(builds), count))
+            return CaseResult(hook_state, self._compare(builds, options, hook_state),
+                              [build for _, build in builds])
+        finally:
+            if self._snapshots is not None:
+                shutil.rmtree(self._snapshots, ignore_errors=True)
+                self._snapshots = None
+
+    @staticmethod
+    def _objects_diverge(first_index, first_units, index, units):
+        """ Compares the objects of two builds, translation unit by translation
+        unit, and reports the first one that diverged
+        """
+        if first_units is None or units is None:
+            return False
+        divergence = objects.first_divergence(first_units, units)
+        if divergence is None:
+            print(Fore.GREEN + "{} objects match".format(len(units)) + Fore.RESET)
+            return False
+        print(Fore.YELLOW + "objects don't match: {} {} (builds {} and {})".format(
+            divergence.name, divergence.reason, first_index, index) + Fore.RESET)
+        return True
+
+    def _compare(self, builds, options, hook_state):
+        """ Compares the package of every build with the first one, as sets of
+        file names and digests, a file missing in a package is a mismatch. If a
+        build failed or timed out nothing is compared, the result is unknown. With
+        --objects the translation units are compared first: they only tell
+        where a mismatch comes from, objects may differ in what the hook
+        patches in the packages. A diverging unit replaces the diff of the
+        binaries.
+        """
+        failed = [(index, build) for index, build in builds if self._failed(build)]
+        for index, build in failed:
+            log_path = self._log_path(options, hook_state, index)
+            print(Fore.RED + Style.BRIGHT + "conan create {} (exit {}), see {}".format(
+                "timed out" if build.run.timed_out else "failed", build.run.returncode,
+                log_path or "its output above") + Fore.RESET + Style.RESET_ALL)
+        if failed:
+            return None
+
+        first_index, first, first_units = None, None, None
+        fail = False
+        for index, build in builds:
+            for bin_file_path, checksum in build.binaries:
+                print(Fore.YELLOW + Style.BRIGHT + "Packaged file: " + bin_file_path +
+                      " with checksum " + checksum + Fore.RESET + Style.RESET_ALL)
+            package = file_digests(build)
+            if first is None:
+                first_index, first, first_units = index, package, build.units
+                continue
+            objects_diverge = self._objects_diverge(first_index, first_units, index, build.units)
+            differing = set(name for name, _ in set(first.items()) ^ set(package.items()))
+            if not differing:
+                print(Fore.GREEN + Style.BRIGHT +
+                      "binaries match!" + Fore.RESET + Style.RESET_ALL)
+                continue
+            fail = True
+            print(Fore.RED + Style.BRIGHT +
+                  "binaries don't match!" + Fore.RESET + Style.RESET_ALL)
+            if first_units and build.units and not objects_diverge:
+                print(Fore.RED + "The objects match, the link diverged" + Fore.RESET)
+            for bin_name in sorted(differing):
+                if bin_name not in first or bin_name not in package:
+                    print(Fore.RED + "{} is only in build {}".format(
+                        bin_name, first_index if bin_name in first else index) + Fore.RESET)
+                    continue
+                if objects_diverge:
+                    continue
+                self._print_chunk_ranges(bin_name, first_index, index)
+                if self._snapshots is not None:
+                    self._print_diff(bin_name, first_index, index)
+
+        if not first:
+            return None
+        return not fail
 
 
 class Case(object):
     def __init__(self, name, checks, activate_hook=False, build_type="Release", shared=False):
         self.name = name
-        self._activate_hook = activate_hook
-        self._build_type = build_type
-        self._shared = shared
+        self.hook = activate_hook
+        self.build_type = build_type
+        self.shared = shared
         self._checks = Check(
-            checks, build_type=self._build_type, shared=self._shared)
-
-    def launch_case(self):
+            checks, build_type=self.build_type, shared=self.shared, name=name)
+        # cases with the same key run exactly the same builds
+        self.key = json.dumps([checks, activate_hook, build_type, shared], sort_keys=True)
+        # the hook on and off cases of a row of the results only differ in the hook
+        self.row = json.dumps([name, checks, build_type, shared], sort_keys=True)
+        # number of builds, by default --repeat or one for every check
+        self.repeat = None
+        # digests of the inputs, and the run and result stored in the history
+        # if they didn't change since it
+        self.inputs = None
+        self.stored = None
+        # the consumer requirement created for the case by launch_cases
+        self.requirement = None
+        self._consumer = any(Check._is_consumer(check) for check in checks)
+
+    def launch_case(self, options=None):
         print("\n")
         print(Fore.LIGHTMAGENTA_EX +
               "CASE: {}".format(self.name) + Fore.RESET)
-        return self._checks.check_library_determinism(self._activate_hook)
+        self._checks.requirement = self.requirement
+        repeat = self.repeat or (options.repeat if options is not None else None)
+        return self._checks.check_library_determinism(self.hook, options, repeat)
+
+    @property
+    def requirement_variant(self):
+        """ (build type, hook state) of the library the case requires, None if
+        it isn't a consumer case
+        """
+        return (self.build_type, self.hook) if self._consumer else None
+
+    @property
+    def identity(self):
+        return self.name, self.hook, self.build_type, self.shared
+
+    def input_digests(self, options):
+        repeat = self.repeat or options.repeat
+        return self._checks.inputs(self.hook, options, repeat)
+
+
+def launch_isolated_case(case, base_conan_home, options):
+    """ Runs a case in a process of the pool with its own Conan cache, nothing
+    global is modified.
+    """
+    user_home = tempfile.mkdtemp(prefix="detcase_")
+    try:
+        copy_conan_config(base_conan_home, os.path.join(user_home, ".conan"))
+        os.environ.update(isolated_env(user_home))
+        return case.launch_case(options)
+    finally:
+        remove_hook_overlays()
+        shutil.rmtree(user_home, ignore_errors=True)
 
 
 def print_results(results):
@@ -212,7 +882,8 @@ def print_results(results):
         False: Fore.RED + "FAIL".ljust(header_justify_s),
         True: Fore.GREEN + "SUCCESS".ljust(header_justify_s)
     }
-    for case_name, result in results.items():
+    for result in results.values():
+        case_name = result["name"]
         msg_hook_on = result_msg[result[True]]
         msg_hook_off = result_msg[result[False]]
         print(Fore.LIGHTMAGENTA_EX +
@@ -221,505 +892,308 @@ def print_results(results):
 
 init()
 
-checks_empty_lib = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeLists.txt": "../library/CMakeLists.txt"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeLists.txt": "../library/CMakeLists.txt"
-        }
-    }
-]
-
-checks_empty_lib_2_dirs = [
-    {
-        "user_channel": "user/channel1",
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp"
-        }
-    },
-    {
-        "user_channel": "user/channel2",
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp"
-        }
-    }
-]
-
-checks_empty_lib_debug_prefix_map = [
-    {
-        "user_channel": "user/channel1",
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsDebugPrefix.txt": "../library/CMakeLists.txt"
-        }
-    },
-    {
-        "user_channel": "user/channel2",
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsDebugPrefix.txt": "../library/CMakeLists.txt"
-        }
-    }
-]
-
-checks_empty_lib_macro_prefix_map = [
-    {
-        "user_channel": "user/channel1",
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsMacroPrefix.txt": "../library/CMakeLists.txt"
-        }
-    },
-    {
-        "user_channel": "user/channel2",
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsMacroPrefix.txt": "../library/CMakeLists.txt"
-        }
-    }
-]
-
-checks_empty_lib_file_prefix_map = [
-    {
-        "user_channel": "user/channel1",
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsFilePrefix.txt": "../library/CMakeLists.txt"
-        }
-    },
-    {
-        "user_channel": "user/channel2",
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsFilePrefix.txt": "../library/CMakeLists.txt"
-        }
-    }
-]
-
-checks_empty_lib_2_dirs_shared = [
-    {
-        "user_channel": "user/channel1",
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp"
-        }
-    },
-    {
-        "user_channel": "user/channel2",
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp"
-        }
-    }
-]
-
-checks_date = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_macros_date.cpp": "../library/src/mydetlib.cpp"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_macros_date.cpp": "../library/src/mydetlib.cpp"
-        }
-    }
-]
-
-checks_time = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_macros_time.cpp": "../library/src/mydetlib.cpp"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_macros_time.cpp": "../library/src/mydetlib.cpp"
-        }
-    }
-]
-
-checks_file = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_macros_file.cpp": "../library/src/mydetlib.cpp"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_macros_file.cpp": "../library/src/mydetlib.cpp"
-        }
-    }
-]
-
-checks_file_2_dirs = [
-    {
-        "user_channel": "user/channel1",
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_macros_file.cpp": "../library/src/mydetlib.cpp"
-        }
-    },
-    {
-        "user_channel": "user/channel2",
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_macros_file.cpp": "../library/src/mydetlib.cpp"
-        }
-    }
-]
-
-
-checks_line = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_macros_line.cpp": "../library/src/mydetlib.cpp"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_macros_line.cpp": "../library/src/mydetlib.cpp"
-        }
-    }
-]
-
-checks_uninitialized_debug = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_uninitialized.cpp": "../library/src/mydetlib.cpp"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_uninitialized.cpp": "../library/src/mydetlib.cpp"
-        }
-    }
-]
-
-checks_uninitialized_release = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_uninitialized.cpp": "../library/src/mydetlib.cpp"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_uninitialized.cpp": "../library/src/mydetlib.cpp"
-        }
-    }
-]
-
-checks_initialized_debug = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_initialized.cpp": "../library/src/mydetlib.cpp"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_initialized.cpp": "../library/src/mydetlib.cpp"
-        }
-    }
-]
-
-checks_initialized_release = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_initialized.cpp": "../library/src/mydetlib.cpp"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_initialized.cpp": "../library/src/mydetlib.cpp"
-        }
-    }
-]
-
-checks_lto_flags = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsLto.txt": "../library/CMakeLists.txt"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsLto.txt": "../library/CMakeLists.txt"
-        }
-    }
-]
-
-checks_random_seed_fix_lto_flags = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsFixLto.txt": "../library/CMakeLists.txt"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsFixLto.txt": "../library/CMakeLists.txt"
-        }
-    }
-]
-
-checks_consumer_empty = [
-    {
-        "folder": "../consumer",
-        "sources":  {
-            "../cases/consumer/main.cpp": "../consumer/src/main.cpp",
-            "../cases/consumer/CMakeLists.txt": "../consumer/CMakeLists.txt"
-        }
-    },
-    {
-        "folder": "../consumer",
-        "sources":  {
-            "../cases/consumer/main.cpp": "../consumer/src/main.cpp",
-            "../cases/consumer/CMakeLists.txt": "../consumer/CMakeLists.txt"
-        }
-    }
-]
-
-checks_consumer_empty_brepro = [
-    {
-        "folder": "../consumer",
-        "sources":  {
-            "../cases/consumer/main.cpp": "../consumer/src/main.cpp",
-            "../cases/consumer/CMakeListsBrepro.txt": "../consumer/CMakeLists.txt"
-        }
-    },
-    {
-        "folder": "../consumer",
-        "sources":  {
-            "../cases/consumer/main.cpp": "../consumer/src/main.cpp",
-            "../cases/consumer/CMakeListsBrepro.txt": "../consumer/CMakeLists.txt"
-        }
-    }
-]
-
-checks_empty_lib_brepro = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsBrepro.txt": "../library/CMakeLists.txt"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_base.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsBrepro.txt": "../library/CMakeLists.txt"
-        }
-    }
-]
-
-checks_lib_d1nodatetime = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_macros_date_time.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsd1nodatetime.txt": "../library/CMakeLists.txt"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/mydetlib_macros_date_time.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsd1nodatetime.txt": "../library/CMakeLists.txt"
-        }
-    }
-]
-
-
-checks_consumer_d1nodatetime = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/consumer/mydetlib_macros_date_time.cpp": "../consumer/src/main.cpp",
-            "../cases/consumer/CMakeListsd1nodatetime.txt": "../consumer/CMakeLists.txt"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/consumer/mydetlib_macros_date_time.cpp": "../consumer/src/main.cpp",
-            "../cases/consumer/CMakeListsd1nodatetime.txt": "../consumer/CMakeLists.txt"
-        }
-    }
-]
-
-checks_empty_lib_multiple_files_same_order = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/multiple_files_lib.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsMultipleFilesA.txt": "../library/CMakeLists.txt",
-            "../cases/lib/sources0.cpp": "../library/src/sources0.cpp",
-            "../cases/lib/sources1.cpp": "../library/src/sources1.cpp",
-            "../cases/lib/sources2.cpp": "../library/src/sources2.cpp",
-            "../cases/lib/sources0.hpp": "../library/include/sources0.hpp",
-            "../cases/lib/sources1.hpp": "../library/include/sources1.hpp",
-            "../cases/lib/sources2.hpp": "../library/include/sources2.hpp"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/multiple_files_lib.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsMultipleFilesA.txt": "../library/CMakeLists.txt",
-        }
-    }
-]
-
-checks_empty_lib_multiple_files_different_order = [
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/multiple_files_lib.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsMultipleFilesA.txt": "../library/CMakeLists.txt",
-            "../cases/lib/sources0.cpp": "../library/src/sources0.cpp",
-            "../cases/lib/sources1.cpp": "../library/src/sources1.cpp",
-            "../cases/lib/sources2.cpp": "../library/src/sources2.cpp",
-            "../cases/lib/sources0.hpp": "../library/include/sources0.hpp",
-            "../cases/lib/sources1.hpp": "../library/include/sources1.hpp",
-            "../cases/lib/sources2.hpp": "../library/include/sources2.hpp"
-        }
-    },
-    {
-        "folder": "../library",
-        "sources":  {
-            "../cases/lib/multiple_files_lib.cpp": "../library/src/mydetlib.cpp",
-            "../cases/lib/CMakeListsMultipleFilesB.txt": "../library/CMakeLists.txt",
-        }
-    }
-]
-
-
-common_cases = [
-    Case("Empty lib Release", checks_empty_lib, False),
-    Case("Consumer Release", checks_consumer_empty, False),
-    Case("Empty lib Release", checks_empty_lib, True),
-    Case("Empty lib Debug", checks_empty_lib, False, build_type="Debug"),
-    Case("Empty lib Debug", checks_empty_lib, True, build_type="Debug"),
-    Case("Empty lib Release, 2 dirs", checks_empty_lib_2_dirs, False),
-    Case("Empty lib Debug, 2 dirs", checks_empty_lib_2_dirs,False, build_type="Debug"),
-    Case("Empty lib Release, 2 dirs", checks_empty_lib_2_dirs, True),
-    Case("Empty lib Debug, 2 dirs", checks_empty_lib_2_dirs, True, build_type="Debug"),
-    Case("Empty lib Debug, 2 dirs with Debug Fix", checks_empty_lib_debug_prefix_map, True, 
-         build_type="Debug"),
-    Case("Empty lib Debug, 2 dirs shared", checks_empty_lib_2_dirs_shared, False, build_type="Debug"),
-    Case("Empty lib Multiple Files Same Order", checks_empty_lib_multiple_files_same_order, True),
-    Case("Empty lib Multiple Files Different Order", checks_empty_lib_multiple_files_different_order, 
-         True),
-    Case("Lib using __DATE__ macro", checks_date, False),
-    Case("Lib using __TIME__ macro", checks_time, False),
-    Case("Lib using __FILE__ macro", checks_file, False),
-    Case("Lib using __FILE__ macro, 2 dirs", checks_file_2_dirs, False),
-    Case("Lib using __DATE__ macro", checks_date, True),
-    Case("Lib using __TIME__ macro", checks_time, True),
-    Case("Lib using __FILE__ macro", checks_file, True),
-    Case("Lib using __FILE__ macro, 2 dirs", checks_file_2_dirs, True)
-]
-
 results = {}
 
 
-def launch_cases(cases):
-    for case in cases:
-        hook_state, success = case.launch_case()
-        if not case.name in results:
-            results[case.name] = {True: None, False: None}
-
-        results[case.name][hook_state] = success
-
-
-compiler, version = get_compiler()
-print("Using compiler {} version {}".format(compiler, version))
-
-launch_cases(common_cases)
-
-if "gcc" in compiler:
-    gcc_cases = [
-        Case("gcc: Use LTO flags", checks_lto_flags, False),
-        Case("gcc: Empty lib Fix LTO", checks_random_seed_fix_lto_flags, False),
-        Case("gcc: Use LTO flags", checks_lto_flags, True),
-        Case("gcc: Empty lib Fix LTO", checks_random_seed_fix_lto_flags, True)
-    ]
-
-    gcc_8_cases = [
-        Case("Lib using __FILE__ macro, 2 dirs Macro Fix",
-             checks_empty_lib_macro_prefix_map, True),
-        Case("Lib using __FILE__ macro, Debug 2 dirs Macro Fix",
-             checks_empty_lib_macro_prefix_map, True, build_type="Debug"),
-        Case("Lib using __FILE__ macro, Debug 2 dirs File Fix",
-             checks_empty_lib_file_prefix_map, True, build_type="Debug")
-    ]
-
-    if int(version) >= 8:
-        gcc_cases.extend(gcc_8_cases)
-
-    launch_cases(gcc_cases)
-
-if "Visual Studio" in compiler:
-    msvc_cases = [
-        Case("msvc: Empty lib Release with /Brepro",
-             checks_empty_lib_brepro, False),
-        Case("msvc: Empty lib Release", checks_empty_lib, False),
-        Case("msvc: Empty Consumer Release", checks_consumer_empty),
-        Case("msvc: Empty Consumer Release with /Brepro",
-             checks_consumer_empty_brepro),
-        Case("msvc: Empty lib Debug with /Brepro",
-             checks_empty_lib_brepro, build_type="Debug"),
-        Case("msvc: Empty lib Debug", checks_empty_lib,
-             False, build_type="Debug"),
-        Case("msvc: Empty Consumer Debug",
-             checks_consumer_empty, build_type="Debug"),
-        Case("msvc: Empty Consumer Debug with /Brepro",
-             checks_consumer_empty_brepro, build_type="Debug"),
-        Case("msvc: Lib using __DATE__ and __TIME__ with d1nodatetime",
-             checks_lib_d1nodatetime, False),
-        Case("msvc: Consumer using __DATE__ and __TIME__ with d1nodatetime",
-             checks_consumer_d1nodatetime, False)
-    ]
-    launch_cases(msvc_cases)
-
-print_results(results)
+def add_result(case, hook_state, success):
+    # keyed by row, cases with the same name but different builds don't overwrite each other
+    if not case.row in results:
+        results[case.row] = {"name": case.name, True: None, False: None}
+
+    results[case.row][hook_state] = success
+
+
+def reuse_unchanged_case(case, history):
+    """ Takes the result of the last run of the case if none of its inputs
+    changed since then
+    """
+    last = history.last_case(case.identity)
+    if last is None:
+        return
+    run, fingerprint, inputs, result = last
+    if fingerprint == inputs_fingerprint(case.inputs):
+        case.stored = run, CaseResult(result["hook_state"], result["success"],
+                                      [stored_build(build) for build in result["builds"]])
+    else:
+        print("{} (hook {}) changed since run {}: {}".format(
+            case.name, "on" if case.hook else "off", run,
+            ", ".join(changed_inputs(inputs, case.inputs))))
+
+
+def launch_cases(case_list, options, writer=None):
+    unique_cases = {}
+    cases_by_key = {}
+    stored_cases = []
+    for case in case_list:
+        # the rows are listed in the order of the cases, not the order they finish
+        results.setdefault(case.row, {"name": case.name, True: None, False: None})
+        if case.stored is not None:
+            stored_cases.append(case)
+            continue
+        unique_cases.setdefault(case.key, case)
+        cases_by_key.setdefault(case.key, []).append(case)
+
+    def _add(case, case_result):
+        add_result(case, case_result.hook_state, case_result.success)
+        if writer is not None:
+            writer.add(case.name, case_result.hook_state, case.build_type, case.shared,
+                       case_result, case.inputs)
+
+    def _finished(key, case_result):
+        for case in cases_by_key[key]:
+            _add(case, case_result)
+
+    for case in stored_cases:
+        run, case_result = case.stored
+        print(Fore.BLUE + "CASE: {} (hook {}) unchanged since run {}".format(
+            case.name, "on" if case.hook else "off", run) + Fore.RESET)
+        _add(case, case_result)
+
+    # the cases are the leaves of a graph whose roots are the variants of the
+    # library the consumer cases require, each variant is created once and
+    # its consumer cases start as soon as it is ready
+    variants = []
+    for case in unique_cases.values():
+        if case.requirement_variant is not None and case.requirement_variant not in variants:
+            variants.append(case.requirement_variant)
+    requirements_folder = tempfile.mkdtemp(prefix="detreq_") if variants else None
+
+    def _requirement_home(variant):
+        return os.path.join(requirements_folder, "{}-hook_{}".format(
+            variant[0], "on" if variant[1] else "off"))
+
+    base_conan_home = get_conan_home()
+    try:
+        if options.jobs <= 1:
+            pinned = {}
+            for key, case in unique_cases.items():
+                variant = case.requirement_variant
+                if variant is not None and variant not in pinned:
+                    pinned[variant] = create_requirement(variant, _requirement_home(variant),
+                                                         base_conan_home, options)
+                case.requirement = pinned.get(variant)
+                _finished(key, case.launch_case(options=options))
+            return
+
+        with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+            # the requirements are submitted first, so they are the first to run
+            futures = {executor.submit(create_requirement, variant, _requirement_home(variant),
+                                       base_conan_home, options): variant
+                       for variant in variants}
+            waiting = {}
+            for key, case in unique_cases.items():
+                if case.requirement_variant is None:
+                    futures[executor.submit(launch_isolated_case, case, base_conan_home,
+                                            options)] = key
+                else:
+                    waiting.setdefault(case.requirement_variant, []).append(key)
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = futures.pop(future)
+                    if node not in waiting:
+                        _finished(node, future.result())
+                        continue
+                    for key in waiting.pop(node):
+                        case = unique_cases[key]
+                        case.requirement = future.result()
+                        submitted = executor.submit(launch_isolated_case, case,
+                                                    base_conan_home, options)
+                        futures[submitted] = key
+                        pending.add(submitted)
+    finally:
+        if requirements_folder is not None:
+            shutil.rmtree(requirements_folder, ignore_errors=True)
+
+
+def get_cases(compiler, version, options):
+    hooks = None if options.hook is None else [options.hook == "on"]
+    for spec in cases.expand(compiler, version, options.filter, hooks, options.build_type):
+        yield Case(spec.name, cases.check_sets[spec.check_set], spec.hook,
+                   build_type=spec.build_type, shared=spec.shared)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Check the determinism of the Conan builds")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of cases launched at the same time, each one with "
+                             "its own Conan cache and copy of the recipes")
+    parser.add_argument("--concurrent-checks", action="store_true",
+                        help="Build the checks in different folders at the same time in "
+                             "separate Conan caches. The builds in the same folder run one "
+                             "after the other in the same cache")
+    parser.add_argument("--hash", choices=algorithms, default="md5",
+                        help="Algorithm used to compute the checksum of the binaries")
+    parser.add_argument("--no-digest-cache", action="store_true",
+                        help="Always hash the binaries instead of reusing the digests "
+                             "stored for unmodified files")
+    parser.add_argument("--hash-packages", action="store_true",
+                        help="Hash every file of the packages instead of reading the md5 "
+                             "of the conanmanifest.txt Conan writes in them")
+    parser.add_argument("--clock", choices=["virtual", "system", "none"],
+                        default="system" if sys.platform == "win32" else "virtual",
+                        help="How every build gets a random time. virtual sets it in the "
+                             "environment of the build, with SOURCE_DATE_EPOCH and libfaketime "
+                             "if it is installed. system changes the clock of the machine on "
+                             "the CI services, which needs root and serial builds. Windows "
+                             "compilers only support system")
+    parser.add_argument("--objects", action="store_true",
+                        help="Hash the objects of the builds with their compile commands from "
+                             "compile_commands.json and compare them before the packages, to "
+                             "tell which translation unit diverged")
+    parser.add_argument("--api-workers", action="store_true",
+                        help="Run conan create in long-lived processes that load the Conan "
+                             "Python API once, instead of starting Conan for every build")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="Seconds after which a conan create is killed")
+    parser.add_argument("--log-dir", default="logs",
+                        help="Folder where the output of every build is written, "
+                             "empty to disable the logs")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Show the output of the builds while they run")
+    parser.add_argument("-f", "--filter", action="append",
+                        help="Only run the cases whose name matches this glob pattern, "
+                             "can be repeated")
+    parser.add_argument("--hook", choices=["on", "off"],
+                        help="Only run the cases with the deterministic hook on or off")
+    parser.add_argument("--build-type", action="append", choices=["Release", "Debug"],
+                        help="Only run the cases with this build type, can be repeated")
+    parser.add_argument("--memo-file",
+                        help="File where the results of the builds are stored to be reused "
+                             "by builds with the same inputs, by default in the Conan home")
+    parser.add_argument("--no-memo", action="store_true",
+                        help="Always build, even if a build with the same inputs was done")
+    parser.add_argument("--chunks", action="store_true",
+                        help="Split the binaries in content defined chunks, stored in the "
+                             "memo and next to the logs, and show the byte ranges that differ "
+                             "between builds")
+    parser.add_argument("--no-diff", action="store_true",
+                        help="Don't report which sections, members and symbols differ "
+                             "when the binaries don't match")
+    parser.add_argument("--results-file",
+                        help="JSON Lines file with a record for every build, written as the "
+                             "cases finish. By default results.jsonl in the log folder")
+    parser.add_argument("--junit-file",
+                        help="JUnit XML summary of the cases, by default junit.xml in the "
+                             "log folder")
+    parser.add_argument("--repeat", type=int,
+                        help="Number of builds of every case, going through its checks in "
+                             "turn. They run one after the other in the same Conan cache, or "
+                             "with --concurrent-checks like the checks, and stop at the first "
+                             "mismatch")
+    parser.add_argument("--adaptive", type=int, metavar="N",
+                        help="Number of builds of the cases that both failed and succeeded in "
+                             "the history, the rest use --repeat")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only run the cases whose sources, recipes, hook, profile or "
+                             "settings changed since their last run in the history, the rest "
+                             "take the result of that run")
+    parser.add_argument("--history-file",
+                        help="Database where the results of every run are appended, by "
+                             "default in the Conan home")
+    parser.add_argument("--no-history", action="store_true",
+                        help="Don't append the results of this run to the history")
+    subparsers = parser.add_subparsers(dest="command")
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare the last run of the history, or the given one, with the "
+                        "previous runs and show the cases that became slower or whose "
+                        "binaries changed")
+    compare_parser.add_argument("--run", type=int,
+                                help="Run to compare, the last one by default")
+    compare_parser.add_argument("--baseline", type=int, default=5,
+                                help="Number of previous runs the run is compared with")
+    compare_parser.add_argument("--sigmas", type=float, default=3.0,
+                                help="Standard deviations above the mean of the baseline "
+                                     "for a case to be slower")
+    compare_parser.add_argument("--min-slowdown", type=float, default=0.1,
+                                help="Minimum fraction above the mean of the baseline for a "
+                                     "case to be slower")
+    compare_parser.add_argument("--min-seconds", type=float, default=1.0,
+                                help="Minimum seconds above the mean of the baseline for a "
+                                     "case to be slower")
+    parser.set_defaults(toolchain=None)
+    return parser
+
+
+def compare_runs(args):
+    if not os.path.isfile(args.history_file):
+        print(Fore.RED + "There is no history in {}".format(args.history_file) + Fore.RESET)
+        return 2
+    history = History(args.history_file)
+    try:
+        findings = compare(history, args.run, args.baseline, args.sigmas, args.min_slowdown,
+                           args.min_seconds)
+    except ValueError as e:
+        print(Fore.RED + str(e) + Fore.RESET)
+        return 2
+    finally:
+        history.close()
+    for finding in findings:
+        print(Fore.RED + "{}: {} {}".format(finding.case, finding.kind, finding.message) +
+              Fore.RESET)
+    if not findings:
+        print(Fore.GREEN + "No case became slower or changed its binaries" + Fore.RESET)
+    return 1 if findings else 0
+
+
+def main():
+    args = get_parser().parse_args()
+    if not args.history_file:
+        args.history_file = os.path.join(get_conan_home(), "determinism_history.sqlite")
+    if args.command == "compare":
+        sys.exit(compare_runs(args))
+
+    if not args.no_digest_cache:
+        # fixed before the cases select their own Conan homes, all of them share it
+        os.environ["DETERMINISTIC_DIGEST_CACHE"] = os.path.abspath(default_cache_path())
+    if not args.no_memo and not args.memo_file:
+        args.memo_file = os.path.join(get_conan_home(), "build_memo.sqlite")
+
+    compiler, version = get_compiler()
+    print("Using compiler {} version {}".format(compiler, version))
+    # part of the fingerprints of the builds, passed to the processes of the pool
+    args.toolchain = toolchain_versions(compiler)
+    for tool, tool_version in sorted(args.toolchain.items()):
+        print("{}: {}".format(tool, tool_version or "not found"))
+
+    results_file = args.results_file
+    junit_file = args.junit_file
+    if args.log_dir:
+        results_file = results_file or os.path.join(args.log_dir, "results.jsonl")
+        junit_file = junit_file or os.path.join(args.log_dir, "junit.xml")
+    if args.clock == "system" and (args.jobs > 1 or args.concurrent_checks):
+        print(Fore.YELLOW + "The system clock is shared by the builds running at the same "
+                            "time, use --clock virtual" + Fore.RESET)
+    if args.incremental and args.no_history:
+        print(Fore.RED + "--incremental needs the history" + Fore.RESET)
+        sys.exit(2)
+    history = None if args.no_history else History(args.history_file)
+    writer = ResultsWriter(results_file, junit_file, compiler, version, args.hash, history)
+    try:
+        case_list = list(get_cases(compiler, version, args))
+        if args.adaptive and history is not None:
+            flaky = history.flaky_cases()
+            for case in case_list:
+                if case.identity in flaky:
+                    print("Sampling flaky case {} {} times".format(case.name, args.adaptive))
+                    case.repeat = args.adaptive
+        if history is not None:
+            for case in case_list:
+                case.inputs = case.input_digests(args)
+                if args.incremental:
+                    reuse_unchanged_case(case, history)
+        launch_cases(case_list, args, writer)
+    finally:
+        writer.close()
+        if history is not None:
+            history.close()
+        remove_hook_overlays()
+        if _conan_workers is not None:
+            _conan_workers.close()
+
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
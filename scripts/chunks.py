@@ -0,0 +1,110 @@
+""" Content defined chunks of the binaries.
+
+The boundaries of the chunks are placed where a rolling gear hash of the
+last bytes matches a mask, so they depend on the contents and not on the
+offsets: a few differing bytes only change the chunks around them, even if
+they shift everything after them. Comparing the chunk lists of two builds
+gives the byte ranges that differ without a full diff.
+"""
+import difflib
+import hashlib
+import json
+import struct
+import sys
+from collections import namedtuple
+
+min_size = 64
+max_size = 8 * 1024
+# the top 9 bits of the hash must be zero, chunks of about 512 bytes
+mask = 0x1ff << 23
+
+_gear = [struct.unpack("<I", hashlib.md5(bytes([value])).digest()[:4])[0] for value in range(256)]
+
+Chunk = namedtuple("Chunk", ["offset", "size", "digest"])
+
+
+def _boundary(data, start):
+    end = min(start + max_size, len(data))
+    position = start + min_size
+    if position >= end:
+        return end
+    gear = _gear
+    value = 0
+    # the bytes before the minimum size don't need to be hashed, the hash
+    # only depends on the last 32 bytes
+    for position in range(position - 32, end):
+        value = ((value << 1) + gear[data[position]]) & 0xffffffff
+        if not value & mask and position >= start + min_size:
+            return position + 1
+    return end
+
+
+def chunk_list(data):
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = _boundary(data, start)
+        chunks.append(Chunk(start, end - start,
+                            hashlib.blake2b(data[start:end], digest_size=16).hexdigest()))
+        start = end
+    return chunks
+
+
+def file_chunks(path):
+    """ Chunk list of a binary, or the one saved with save() in a json file,
+    for the command line
+    """
+    if path.endswith(".json"):
+        with open(path) as f:
+            return [Chunk(*chunk) for chunk in json.load(f)]
+    with open(path, "rb") as f:
+        return chunk_list(f.read())
+
+
+def save(chunks, path):
+    with open(path, "w") as f:
+        json.dump([list(chunk) for chunk in chunks], f)
+
+
+def differing_ranges(chunks_a, chunks_b):
+    """ Pairs of (start, end) ranges of the first and the second build that
+    differ, one of them is empty when the bytes were only removed or added
+    """
+    matcher = difflib.SequenceMatcher(None, [chunk.digest for chunk in chunks_a],
+                                      [chunk.digest for chunk in chunks_b], autojunk=False)
+    ranges = []
+
+    def _range(chunks, first, last):
+        if first == last:
+            offset = chunks[first].offset if first < len(chunks) else \
+                (chunks[-1].offset + chunks[-1].size if chunks else 0)
+            return offset, offset
+        return chunks[first].offset, chunks[last - 1].offset + chunks[last - 1].size
+
+    for tag, first_a, last_a, first_b, last_b in matcher.get_opcodes():
+        if tag != "equal":
+            ranges.append((_range(chunks_a, first_a, last_a), _range(chunks_b, first_b, last_b)))
+    return ranges
+
+
+def report(ranges):
+    lines = []
+    for (start_a, end_a), (start_b, end_b) in ranges:
+        lines.append("[0x{:x}-0x{:x}] {} bytes in the first build, [0x{:x}-0x{:x}] {} bytes in "
+                     "the second".format(start_a, end_a, end_a - start_a,
+                                         start_b, end_b, end_b - start_b))
+    return lines
+
+
+def main(args):
+    if len(args) != 2:
+        print("usage: chunks.py <binary or chunks.json> <binary or chunks.json>")
+        return 2
+    ranges = differing_ranges(file_chunks(args[0]), file_chunks(args[1]))
+    for line in report(ranges):
+        print(line)
+    return 1 if ranges else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
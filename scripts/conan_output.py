@@ -0,0 +1,85 @@
+import os
+import re
+from collections import namedtuple
+
+PACKAGED_FILE = "packaged_file"
+LINKED_LIBRARY = "linked_library"
+LINKED_EXECUTABLE = "linked_executable"
+PACKAGE_FOLDER = "package_folder"
+BUILD_FOLDER = "build_folder"
+PACKAGE_REVISION = "package_revision"
+HOOK_MESSAGE = "hook_message"
+
+Event = namedtuple("Event", ["kind", "value"])
+
+binary_extensions = (".lib", ".exe", ".dll", ".a", ".so", ".dylib")
+# folders of the package where the binaries are copied
+binary_subdirs = ["lib", "bin", "dll"]
+
+_ansi_escape = re.compile(r"\x1b\[[0-9;]*m")
+_packaged = re.compile(r"Packaged .*\bfiles?: (.+)$")
+_linking = re.compile(r"Linking \w+ (?:static |shared |module )?(library|executable) (.+)$")
+_package_folder = re.compile(r"Package folder (.+)$")
+_build_folder = re.compile(r"Building your package in (.+)$")
+_package_revision = re.compile(r"Created package revision (\w+)")
+
+
+class ConanOutputParser(object):
+    """ Parses the output of 'conan create' line by line as it is produced and
+    keeps only what the checks need, not the whole log
+    """
+    def __init__(self):
+        self.binaries = []
+        self.package_folder = None
+        self.build_folder = None
+        self.package_revision = None
+        self.hook_messages = []
+
+    def feed(self, line):
+        """ Consumes a decoded line and returns the events found in it """
+        line = _ansi_escape.sub("", line).rstrip("\r\n")
+        events = []
+        if "HOOK - deterministic" in line:
+            self.hook_messages.append(line)
+            events.append(Event(HOOK_MESSAGE, line))
+
+        match = _packaged.search(line)
+        if match:
+            for filename in match.group(1).split(","):
+                filename = filename.strip()
+                if filename.endswith(binary_extensions):
+                    events.append(Event(PACKAGED_FILE, filename))
+        match = _linking.search(line)
+        if match:
+            kind = LINKED_LIBRARY if match.group(1) == "library" else LINKED_EXECUTABLE
+            events.append(Event(kind, os.path.basename(match.group(2).strip())))
+        match = _package_folder.search(line)
+        if match:
+            self.package_folder = os.path.abspath(match.group(1).strip())
+            events.append(Event(PACKAGE_FOLDER, self.package_folder))
+        match = _build_folder.search(line)
+        if match:
+            self.build_folder = os.path.abspath(match.group(1).strip())
+            events.append(Event(BUILD_FOLDER, self.build_folder))
+        match = _package_revision.search(line)
+        if match:
+            self.package_revision = match.group(1)
+            events.append(Event(PACKAGE_REVISION, self.package_revision))
+
+        for event in events:
+            if event.kind in (PACKAGED_FILE, LINKED_LIBRARY, LINKED_EXECUTABLE) and \
+                    event.value not in self.binaries:
+                self.binaries.append(event.value)
+        return events
+
+    def binary_paths(self):
+        """ Paths of the binaries found in the package folder """
+        if self.package_folder is None:
+            return []
+        paths = []
+        for subdir in binary_subdirs:
+            for binary in self.binaries:
+                path = os.path.join(self.package_folder, subdir, binary)
+                if os.path.isfile(path) and path not in paths:
+                    paths.append(path)
+        return paths
@@ -0,0 +1,230 @@
+""" Long-lived processes that run conan create with the Conan Python API, so
+the interpreter and Conan are loaded once for many builds instead of once per
+build.
+
+The requests are json lines written to the stdin of the worker. Everything the
+worker writes to stdout is the output of the builds, as conan create would
+print it, except the lines starting with the protocol prefix, which carry the
+json result of the request.
+"""
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+from runner import RunResult, kill_tree
+
+prefix = "\x1edeterministic-worker "
+
+
+class CreateRequest(namedtuple("CreateRequest", ["folder", "user_channel", "settings",
+                                                 "package_options"])):
+    """ A conan create of the recipe in folder, settings and package options
+    are lists of name=value
+    """
+    def command(self):
+        arguments = "".join(" -s {}".format(setting) for setting in self.settings)
+        arguments += "".join(" -o {}".format(option) for option in self.package_options)
+        return "cd {} && conan create . {}{}".format(self.folder, self.user_channel, arguments)
+
+
+# Worker side
+
+def _usage():
+    if os.name != "posix":
+        return None
+    import resource
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + children.ru_utime, own.ru_stime + children.ru_stime,
+            children.ru_maxrss)
+
+
+def _conan_api():
+    from conans.client.conan_api import Conan
+    factory = getattr(Conan, "factory", None)
+    if factory is None:
+        return Conan()
+    api = factory()
+    return api[0] if isinstance(api, tuple) else api
+
+
+def _package_folder(info):
+    for installed in (info or {}).get("installed", []):
+        for package in installed.get("packages", []):
+            folder = package.get("cpp_info", {}).get("rootpath")
+            if folder:
+                return folder
+    return None
+
+
+def _files(folder):
+    if not folder or not os.path.isdir(folder):
+        return []
+    return sorted(os.path.relpath(os.path.join(root, filename), folder).replace(os.sep, "/")
+                  for root, _, filenames in os.walk(folder) for filename in filenames)
+
+
+def _create(request):
+    """ Runs the request with the environment of the build, the compilers that
+    Conan launches inherit it
+    """
+    os.environ.clear()
+    os.environ.update(request["env"])
+    os.chdir(request["folder"])
+    user, channel = request["user_channel"].split("/")
+    returncode = 0
+    info = None
+    try:
+        conan_api = _conan_api()
+        info = conan_api.create(".", user=user, channel=channel, settings=request["settings"],
+                                options=request["package_options"], cwd=request["folder"])
+    except Exception as e:
+        info = getattr(e, "info", None)
+        print("ERROR: {}".format(e))
+        returncode = 1
+    package_folder = _package_folder(info)
+    return {"returncode": returncode, "package_folder": package_folder,
+            "files": _files(package_folder)}
+
+
+def serve():
+    protocol = sys.stdout
+    for line in sys.stdin:
+        request = json.loads(line)
+        start = time.time()
+        usage = _usage()
+        try:
+            result = _create(request)
+        except Exception:
+            traceback.print_exc()
+            result = {"returncode": 1, "package_folder": None, "files": []}
+        end_usage = _usage()
+        result["wall"] = time.time() - start
+        if usage is not None:
+            result["user"] = end_usage[0] - usage[0]
+            result["sys"] = end_usage[1] - usage[1]
+            # the peak of the biggest process the worker waited for, not only this build
+            result["max_rss_kb"] = end_usage[2] / 1024.0 if sys.platform == "darwin" \
+                else end_usage[2]
+        sys.stdout.flush()
+        sys.stderr.flush()
+        protocol.write(prefix + json.dumps(result) + "\n")
+        protocol.flush()
+
+
+# Client side
+
+class ConanWorker(object):
+    """ A worker process, restarted if it dies or is killed by a timeout """
+    def __init__(self):
+        self._process = None
+
+    def _start(self):
+        kwargs = {"start_new_session": True} if os.name == "posix" else {}
+        self._process = subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT, **kwargs)
+
+    def create(self, request, env, on_line=None, log_path=None, timeout=None, echo=False):
+        """ Runs the request like run_streaming runs a command, returns its
+        RunResult and the package folder and files reported by Conan
+        """
+        if self._process is None or self._process.poll() is not None:
+            self._start()
+        message = dict(request._asdict(), folder=os.path.abspath(request.folder),
+                       env=dict(os.environ if env is None else env))
+        self._process.stdin.write((json.dumps(message) + "\n").encode("utf-8"))
+        self._process.stdin.flush()
+
+        start = time.time()
+        timed_out = []
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, kill_tree, (self._process, timed_out))
+            timer.daemon = True
+            timer.start()
+        result = None
+        log = open(log_path, "wb") if log_path else None
+        try:
+            for line in self._process.stdout:
+                text = line.decode("utf-8", "replace")
+                # the result is glued to the last output of the build if it
+                # didn't end with a newline
+                position = text.find(prefix)
+                if position != -1:
+                    result = json.loads(text[position + len(prefix):])
+                    text = text[:position]
+                    line = text.encode("utf-8")
+                if text:
+                    if log is not None:
+                        log.write(line)
+                    if echo:
+                        sys.stdout.write(text)
+                    if on_line is not None:
+                        on_line(text)
+                if result is not None:
+                    break
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if log is not None:
+                log.close()
+
+        if result is None:
+            # the worker died or was killed, the next request starts a new one
+            self.close()
+            return RunResult(-9 if timed_out else 1, bool(timed_out), time.time() - start,
+                             None, None, None), {}
+        run_result = RunResult(result["returncode"], False, result["wall"], result.get("user"),
+                               result.get("sys"), result.get("max_rss_kb"))
+        return run_result, result
+
+    def close(self):
+        if self._process is None:
+            return
+        if self._process.poll() is None:
+            self._process.stdin.close()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                kill_tree(self._process, [])
+        self._process = None
+
+
+class WorkerPool(object):
+    """ Workers shared by the threads of a process, a build takes a free one
+    or starts a new worker if all of them are busy
+    """
+    def __init__(self):
+        self._free = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def create(self, request, env, **kwargs):
+        try:
+            worker = self._free.get_nowait()
+        except queue.Empty:
+            worker = ConanWorker()
+            with self._lock:
+                self._workers.append(worker)
+        try:
+            return worker.create(request, env, **kwargs)
+        finally:
+            self._free.put(worker)
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+            self._workers = []
+        self._free = queue.Queue()
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,177 @@
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+algorithms = ["md5", "sha256", "blake2b"]
+
+chunk_size = 1024 * 1024
+# files bigger than this are mapped in memory instead of read in chunks
+mmap_threshold = 16 * 1024 * 1024
+
+
+class Digest(namedtuple("Digest", ["path", "algorithm", "hexdigest", "size"])):
+    def __str__(self):
+        return self.hexdigest
+
+
+def file_digest(path, algorithm="md5"):
+    hasher = hashlib.new(algorithm)
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if size >= mmap_threshold:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                hasher.update(mapped)
+            finally:
+                mapped.close()
+        else:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                hasher.update(chunk)
+    return Digest(path, algorithm, hasher.hexdigest(), size)
+
+
+class DigestCache(object):
+    """ Persistent digests of files keyed by their stat metadata. The sqlite
+    file is selected by DETERMINISTIC_DIGEST_CACHE, by default it lives in the
+    Conan home. It is only opened when a file is hashed, and the rows of the
+    files that no longer exist, like the ones of removed temporary Conan
+    caches, are deleted when it is closed.
+    """
+    # files modified this recently could change again within the same mtime
+    # granularity without being noticed, they are hashed but not stored
+    racy_seconds = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            with self._db:
+                self._db.execute("CREATE TABLE IF NOT EXISTS digests (path TEXT, algorithm TEXT, "
+                                 "size INTEGER, mtime_ns INTEGER, inode INTEGER, hexdigest TEXT, "
+                                 "PRIMARY KEY (path, algorithm))")
+        return self._db
+
+    @staticmethod
+    def _key(stat):
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def digest(self, path, algorithm="md5"):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            row = self._connect().execute("SELECT size, mtime_ns, inode, hexdigest FROM digests "
+                                   "WHERE path=? AND algorithm=?", (path, algorithm)).fetchone()
+        if row is not None and tuple(row[:3]) == self._key(stat):
+            with self._lock:
+                self.hits += 1
+                self.bytes_saved += stat.st_size
+            return Digest(path, algorithm, row[3], stat.st_size)
+
+        digest = file_digest(path, algorithm)
+        with self._lock:
+            self.misses += 1
+            racy = time.time() - stat.st_mtime < self.racy_seconds
+            if not racy and self._key(os.stat(path)) == self._key(stat):
+                with self._db:
+                    self._db.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+                                     (path, algorithm) + self._key(stat) + (digest.hexdigest,))
+        return digest
+
+    @property
+    def used(self):
+        return bool(self.hits or self.misses)
+
+    def stats(self):
+        return "{} hits, {} misses, {} bytes not hashed again".format(
+            self.hits, self.misses, self.bytes_saved)
+
+    def prune(self):
+        """ Deletes the rows of the files that don't exist anymore """
+        with self._lock:
+            db = self._connect()
+            missing = [(path,) for path, in db.execute("SELECT DISTINCT path FROM digests")
+                       if not os.path.exists(path)]
+            with db:
+                db.executemany("DELETE FROM digests WHERE path=?", missing)
+        return len(missing)
+
+    def close(self):
+        if self._db is None:
+            return
+        try:
+            self.prune()
+        except sqlite3.Error:
+            pass
+        self._db.close()
+        self._db = None
+
+
+def default_cache_path():
+    path = os.environ.get("DETERMINISTIC_DIGEST_CACHE")
+    if path:
+        return path
+    user_home = os.environ.get("CONAN_USER_HOME", os.path.expanduser("~"))
+    return os.path.join(user_home, ".conan", "digests.sqlite")
+
+
+def files_digests(paths, algorithm="md5", jobs=None, cache=None):
+    """ Hashes the files in a thread pool, hashlib releases the GIL while hashing
+    so big binaries are processed in parallel. Results keep the order of paths.
+    """
+    if cache is not None:
+        hash_file = lambda path: cache.digest(path, algorithm)
+    else:
+        hash_file = lambda path: file_digest(path, algorithm)
+    paths = list(paths)
+    if len(paths) <= 1:
+        return [hash_file(path) for path in paths]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(hash_file, paths))
+
+
+def read_conan_manifest(package_folder):
+    """ md5 of the files of a package by path relative to it, from the
+    conanmanifest.txt Conan writes in the package folder. None if it has none.
+    """
+    path = os.path.join(package_folder, "conanmanifest.txt")
+    if not os.path.isfile(path):
+        return None
+    digests = {}
+    with open(path) as f:
+        # the first line is the time the manifest was created
+        for line in f.read().splitlines()[1:]:
+            filename, _, hexdigest = line.rpartition(": ")
+            if filename:
+                digests[filename] = hexdigest
+    return digests
+
+
+def package_digests(package_folder, algorithm="md5", jobs=None, cache=None, use_manifest=True):
+    """ Digests of every file of a package folder by path relative to it. The
+    Conan manifest is used for md5 unless use_manifest is False, otherwise the
+    whole folder is hashed in one parallel pass.
+    """
+    if algorithm == "md5" and use_manifest:
+        digests = read_conan_manifest(package_folder)
+        if digests is not None:
+            return digests
+    paths = []
+    for root, _, filenames in os.walk(package_folder):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if os.path.relpath(path, package_folder) != "conanmanifest.txt":
+                paths.append(path)
+    return {os.path.relpath(digest.path, package_folder).replace(os.sep, "/"): digest.hexdigest
+            for digest in files_digests(paths, algorithm, jobs, cache)}
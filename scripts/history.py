@@ -0,0 +1,177 @@
+""" Results of the previous runs, to notice the cases that became slower or
+whose binaries changed with a new toolchain or hook.
+"""
+import json
+import math
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+Finding = namedtuple("Finding", ["case", "kind", "message"])
+
+SLOWER = "slower"
+DIGESTS = "digests"
+
+
+def _case_id(row):
+    case_name, hook, build_type, shared = row
+    return "{} ({}, hook {}{})".format(case_name, build_type, "on" if hook else "off",
+                                       ", shared" if shared else "")
+
+
+class History(object):
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY "
+                             "AUTOINCREMENT, started TEXT, compiler TEXT, version TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS builds (run INTEGER, case_name TEXT, "
+                             "hook INTEGER, build_type TEXT, shared INTEGER, build INTEGER, "
+                             "success INTEGER, reused INTEGER, returncode INTEGER, wall REAL, "
+                             "user REAL, sys REAL, max_rss_kb REAL, package_revision TEXT, "
+                             "binaries TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS cases (run INTEGER, case_name TEXT, "
+                             "hook INTEGER, build_type TEXT, shared INTEGER, fingerprint TEXT, "
+                             "inputs TEXT, result TEXT)")
+
+    def start_run(self, compiler, version):
+        with self._lock:
+            with self._db:
+                cursor = self._db.execute("INSERT INTO runs (started, compiler, version) "
+                                          "VALUES (?, ?, ?)",
+                                          (datetime.now().isoformat(), compiler, version))
+        return cursor.lastrowid
+
+    def add(self, run, records):
+        """ Stores the records of the builds of a case, as written by the
+        ResultsWriter
+        """
+        rows = [(run, record["case"], record["hook"], record["build_type"], record["shared"],
+                 record["build"], record["success"], record["reused"], record.get("returncode"),
+                 record.get("wall"), record.get("user"), record.get("sys"),
+                 record.get("max_rss_kb"), record["package_revision"],
+                 json.dumps(record["binaries"], sort_keys=True))
+                for record in records]
+        with self._lock:
+            with self._db:
+                self._db.executemany("INSERT INTO builds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, "
+                                     "?, ?, ?, ?)", rows)
+
+    def add_case(self, run, case, fingerprint, inputs, result):
+        """ Stores the digests of the inputs of a case and its result, case is
+        (case name, hook, build type, shared)
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute("INSERT INTO cases VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (run,) + tuple(case) + (fingerprint, json.dumps(inputs),
+                                                         json.dumps(result)))
+
+    def last_case(self, case):
+        """ run, fingerprint, inputs and result of the last run of the case """
+        row = self._db.execute("SELECT run, fingerprint, inputs, result FROM cases WHERE "
+                               "case_name=? AND hook=? AND build_type=? AND shared=? ORDER BY "
+                               "rowid DESC LIMIT 1", tuple(case)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2]), json.loads(row[3])
+
+    def runs(self):
+        return self._db.execute("SELECT id, started, compiler, version FROM runs "
+                                "ORDER BY id").fetchall()
+
+    def case_times(self, run):
+        """ Wall time of every case in the run, builds reused from the memo
+        didn't take any time and cases with any of them are left out
+        """
+        rows = self._db.execute("SELECT case_name, hook, build_type, shared, SUM(wall), "
+                                "MAX(reused) FROM builds WHERE run=? GROUP BY case_name, hook, "
+                                "build_type, shared", (run,)).fetchall()
+        return {row[:4]: row[4] for row in rows if not row[5] and row[4] is not None}
+
+    def case_digests(self, run):
+        result = {}
+        for row in self._db.execute("SELECT case_name, hook, build_type, shared, build, "
+                                    "binaries FROM builds WHERE run=?", (run,)):
+            digests = result.setdefault(row[:4], {})
+            for binary in json.loads(row[5]):
+                name = "{}#{}".format(os.path.basename(binary["path"]), row[4])
+                digests[name] = binary["digest"]
+        return result
+
+    def flaky_cases(self):
+        """ (case name, hook, build type, shared) of the cases that failed and
+        succeeded in different runs
+        """
+        rows = self._db.execute("SELECT case_name, hook, build_type, shared FROM builds WHERE "
+                                "success IS NOT NULL GROUP BY case_name, hook, build_type, "
+                                "shared HAVING MIN(success) = 0 AND MAX(success) = 1")
+        return set((name, bool(hook), build_type, bool(shared))
+                   for name, hook, build_type, shared in rows)
+
+    def close(self):
+        self._db.close()
+
+
+def _mean_stdev(values):
+    mean = sum(values) / len(values)
+    if len(values) < 2:
+        return mean, 0.0
+    return mean, math.sqrt(sum((value - mean) ** 2 for value in values) / (len(values) - 1))
+
+
+def compare(history, run=None, baseline=5, sigmas=3.0, min_slowdown=0.1, min_seconds=1.0):
+    """ Findings of a run, by default the last one, against the previous
+    baseline runs. A case is slower when its time is more than sigmas
+    standard deviations, min_slowdown (a fraction) and min_seconds above the
+    mean of the baseline. Digests are compared with the last baseline run with the case.
+    """
+    runs = history.runs()
+    ids = [row[0] for row in runs]
+    if run is None:
+        run = ids[-1] if ids else None
+    if run not in ids:
+        raise ValueError("Run {} is not in the history {}".format(run, history.path))
+    position = ids.index(run)
+    baseline_runs = runs[max(0, position - baseline):position]
+    current = runs[position]
+    findings = []
+
+    times = history.case_times(run)
+    baseline_times = {}
+    for baseline_run in baseline_runs:
+        for case, wall in history.case_times(baseline_run[0]).items():
+            baseline_times.setdefault(case, []).append(wall)
+    for case, wall in sorted(times.items()):
+        previous = baseline_times.get(case)
+        if not previous:
+            continue
+        mean, stdev = _mean_stdev(previous)
+        if wall > mean * (1 + min_slowdown) and wall > mean + max(sigmas * stdev, min_seconds):
+            findings.append(Finding(_case_id(case), SLOWER,
+                                    "{:.1f}s, was {:.1f}s +- {:.1f}s in {} runs".format(
+                                        wall, mean, stdev, len(previous))))
+
+    digests = history.case_digests(run)
+    baseline_digests = {row[0]: history.case_digests(row[0]) for row in baseline_runs}
+    for case, case_digests in sorted(digests.items()):
+        for baseline_run in reversed(baseline_runs):
+            previous = baseline_digests[baseline_run[0]].get(case)
+            if previous is None:
+                continue
+            changed = sorted(name for name, digest in case_digests.items()
+                             if name in previous and previous[name] != digest)
+            if changed:
+                toolchain = "{} {}".format(current[2], current[3])
+                previous_toolchain = "{} {}".format(baseline_run[2], baseline_run[3])
+                cause = "with the same toolchain" if toolchain == previous_toolchain else \
+                    "from {} to {}".format(previous_toolchain, toolchain)
+                findings.append(Finding(_case_id(case), DIGESTS,
+                                        "{} changed since run {} {}".format(
+                                            ", ".join(changed), baseline_run[0], cause)))
+            break
+    return findings
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+def build_fingerprint(manifests, settings, files=()):
+    """ Fingerprint of a build: the contents of its inputs, given as staging
+    manifests (staged path to source file), the settings (a json serializable
+    object) and other files that affect the build, like the hook or the profile.
+    Missing files are fingerprinted as such.
+    """
+    hasher = hashlib.sha256()
+    for inputs in manifests:
+        for dst, src in sorted(inputs.items()):
+            hasher.update(dst.encode("utf-8") + b"\x00")
+            with open(src, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+            hasher.update(b"\x00")
+    hasher.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    for path in files:
+        hasher.update(b"\x00" + os.path.basename(path).encode("utf-8") + b"\x00")
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                hasher.update(f.read())
+    return hasher.hexdigest()
+
+
+def _file_digest(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def input_digests(manifests, files, settings):
+    """ Digest of every input of a case, to tell which ones changed between
+    runs: the files of the staging manifests given by label, other files by
+    label and the settings
+    """
+    result = {}
+    for label, inputs in manifests.items():
+        for dst, src in inputs.items():
+            result["{}: {}".format(label, dst)] = _file_digest(src)
+    for label, path in files.items():
+        result[label] = _file_digest(path)
+    result["settings"] = hashlib.sha256(json.dumps(settings, sort_keys=True)
+                                        .encode("utf-8")).hexdigest()
+    return result
+
+
+def inputs_fingerprint(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def changed_inputs(previous, current):
+    return sorted(label for label in set(previous) | set(current)
+                  if previous.get(label) != current.get(label))
+
+
+class BuildMemo(object):
+    """ Results of previous builds keyed by the fingerprint of their inputs """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS builds (fingerprint TEXT PRIMARY KEY, "
+                             "result TEXT)")
+
+    def get(self, fingerprint):
+        with self._lock:
+            row = self._db.execute("SELECT result FROM builds WHERE fingerprint=?",
+                                   (fingerprint,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, fingerprint, result):
+        with self._lock:
+            with self._db:
+                self._db.execute("INSERT OR REPLACE INTO builds VALUES (?, ?)",
+                                 (fingerprint, json.dumps(result)))
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,119 @@
+""" Object files of a build, one per translation unit, with the command that
+compiled each of them, taken from the compile_commands.json CMake writes
+when CMAKE_EXPORT_COMPILE_COMMANDS is set.
+
+Comparing the objects of two builds before their linked binaries tells
+which translation unit diverged, or that all of them match and the link
+did, without diffing the whole binaries.
+"""
+import json
+import os
+import shlex
+import sys
+from collections import namedtuple
+
+from digest import file_digest
+
+object_extensions = (".o", ".obj")
+# the build folders of two builds are never the same, it is replaced in the commands
+build_placeholder = "<build>"
+
+Unit = namedtuple("Unit", ["name", "digest", "command"])
+Divergence = namedtuple("Divergence", ["name", "reason"])
+
+ONLY_IN_FIRST = "only in the first build"
+ONLY_IN_SECOND = "only in the second build"
+COMMAND = "compiled with a different command"
+OBJECT = "differs with the same command"
+
+
+def _arguments(entry):
+    if "arguments" in entry:
+        return list(entry["arguments"])
+    return shlex.split(entry.get("command", ""), posix=os.name != "nt")
+
+
+def _output(entry, arguments):
+    if entry.get("output"):
+        return entry["output"]
+    for index, argument in enumerate(arguments):
+        if argument == "-o" and index + 1 < len(arguments):
+            return arguments[index + 1]
+        if argument.startswith(("/Fo", "-Fo")):
+            return argument[3:]
+    return None
+
+
+def compile_commands(build_folder):
+    """ Command of every object of the compile_commands.json files in the build
+    folder, by the normalized path of the object
+    """
+    commands = {}
+    for root, _, filenames in os.walk(build_folder):
+        if "compile_commands.json" not in filenames:
+            continue
+        with open(os.path.join(root, "compile_commands.json")) as f:
+            entries = json.load(f)
+        for entry in entries:
+            arguments = _arguments(entry)
+            output = _output(entry, arguments)
+            if output is None:
+                continue
+            path = os.path.join(entry.get("directory", root), output)
+            command = " ".join(arguments).replace(build_folder, build_placeholder)
+            commands[os.path.normcase(os.path.normpath(path))] = command
+    return commands
+
+
+def units(build_folder, algorithm="md5"):
+    """ Sorted units of the objects in the build folder, the command is None if
+    the object isn't in any compile_commands.json
+    """
+    build_folder = os.path.abspath(build_folder)
+    commands = compile_commands(build_folder)
+    result = []
+    for root, _, filenames in os.walk(build_folder):
+        for filename in filenames:
+            if not filename.endswith(object_extensions):
+                continue
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, build_folder).replace(os.sep, "/")
+            command = commands.get(os.path.normcase(os.path.normpath(path)))
+            result.append(Unit(name, file_digest(path, algorithm).hexdigest, command))
+    return sorted(result)
+
+
+def first_divergence(first, second):
+    """ Divergence of the first unit, in name order, that doesn't match in the
+    two lists of units, None if all of them match
+    """
+    first = {unit.name: unit for unit in first}
+    second = {unit.name: unit for unit in second}
+    for name in sorted(set(first) | set(second)):
+        if name not in second:
+            return Divergence(name, ONLY_IN_FIRST)
+        if name not in first:
+            return Divergence(name, ONLY_IN_SECOND)
+        if first[name].digest == second[name].digest:
+            continue
+        if first[name].command != second[name].command:
+            return Divergence(name, COMMAND)
+        return Divergence(name, OBJECT)
+    return None
+
+
+def main(args):
+    if len(args) != 2:
+        print("usage: objects.py <build folder> <build folder>")
+        return 2
+    first, second = units(args[0]), units(args[1])
+    divergence = first_divergence(first, second)
+    if divergence is None:
+        print("{} objects match".format(len(first)))
+        return 0
+    print("{}: {}".format(divergence.name, divergence.reason))
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
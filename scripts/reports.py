@@ -0,0 +1,106 @@
+""" Machine readable results of the cases: a json line for every build,
+written as soon as its case finishes, and a JUnit XML summary at the end.
+The records are also appended to the history of the runs if there is one.
+"""
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime
+
+from memo import inputs_fingerprint
+
+
+def _parent(path):
+    folder = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+
+class ResultsWriter(object):
+    def __init__(self, jsonl_path, junit_path, compiler, version, algorithm, history=None):
+        self._jsonl_path = jsonl_path
+        self._junit_path = junit_path
+        self._compiler = compiler
+        self._version = version
+        self._algorithm = algorithm
+        self._cases = []
+        self._history = history
+        self._run = history.start_run(compiler, version) if history is not None else None
+        self._jsonl = None
+        if jsonl_path:
+            _parent(jsonl_path)
+            self._jsonl = open(jsonl_path, "w")
+
+    def build_records(self, name, hook_state, build_type, shared, case_result):
+        records = []
+        for index, build in enumerate(case_result.builds):
+            record = {
+                "case": name,
+                "hook": hook_state,
+                "build_type": build_type,
+                "shared": shared,
+                "compiler": self._compiler,
+                "compiler_version": self._version,
+                "build": index,
+                "success": case_result.success,
+                "binaries": [{"path": path, "digest": digest, "algorithm": self._algorithm}
+                             for path, digest in build.binaries],
+                "package_revision": build.package_revision,
+                "reused": build.reused
+            }
+            if build.run is not None:
+                record.update(build.run._asdict())
+            records.append(record)
+        return records
+
+    def add(self, name, hook_state, build_type, shared, case_result, inputs=None):
+        """ Writes the records of the builds of a case that just finished, the
+        digests of its inputs are kept in the history to reuse the result
+        """
+        self._cases.append((name, hook_state, case_result))
+        records = self.build_records(name, hook_state, build_type, shared, case_result)
+        if self._history is not None:
+            self._history.add(self._run, records)
+            if inputs is not None:
+                result = {"hook_state": case_result.hook_state, "success": case_result.success,
+                          "builds": [build._asdict() for build in case_result.builds]}
+                self._history.add_case(self._run, (name, hook_state, build_type, shared),
+                                       inputs_fingerprint(inputs), inputs, result)
+        if self._jsonl is None:
+            return
+        for record in records:
+            record["finished"] = datetime.now().isoformat()
+            self._jsonl.write(json.dumps(record, sort_keys=True) + "\n")
+        self._jsonl.flush()
+
+    def _junit(self):
+        suite = ElementTree.Element("testsuite", name="determinism", tests=str(len(self._cases)))
+        failures = skipped = 0
+        total_time = 0.0
+        for name, hook_state, case_result in self._cases:
+            time = sum(build.run.wall for build in case_result.builds if build.run is not None)
+            total_time += time
+            testcase = ElementTree.SubElement(suite, "testcase", classname=name,
+                                              name="hook {}".format("on" if hook_state else "off"),
+                                              time="{:.3f}".format(time))
+            if case_result.success is False:
+                failures += 1
+                digests = ["{} {}".format(os.path.basename(path), digest)
+                           for build in case_result.builds for path, digest in build.binaries]
+                failure = ElementTree.SubElement(testcase, "failure", message="binaries don't match")
+                failure.text = "\n".join(digests)
+            elif case_result.success is None:
+                skipped += 1
+                ElementTree.SubElement(testcase, "skipped",
+                                       message="the builds failed or created no binaries")
+        suite.set("failures", str(failures))
+        suite.set("skipped", str(skipped))
+        suite.set("time", "{:.3f}".format(total_time))
+        return ElementTree.ElementTree(suite)
+
+    def close(self):
+        if self._jsonl is not None:
+            self._jsonl.close()
+        if self._junit_path:
+            _parent(self._junit_path)
+            self._junit().write(self._junit_path, encoding="utf-8", xml_declaration=True)
@@ -0,0 +1,80 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+
+
+class RunResult(namedtuple("RunResult", ["returncode", "timed_out", "wall", "user", "sys",
+                                         "max_rss_kb"])):
+    def __str__(self):
+        msg = "wall {:.1f}s".format(self.wall)
+        if self.user is not None:
+            msg += ", user {:.1f}s, sys {:.1f}s, peak RSS {:.1f} MB".format(
+                self.user, self.sys, self.max_rss_kb / 1024.0)
+        return msg
+
+
+def kill_tree(process, timed_out):
+    timed_out.append(True)
+    if os.name == "posix":
+        import signal
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    else:
+        subprocess.call("taskkill /F /T /PID {}".format(process.pid),
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_streaming(cmd, on_line=None, env=None, log_path=None, timeout=None, echo=False):
+    """ Runs a shell command reading stdout and stderr line by line as they are
+    produced. Every line is passed to on_line, written to log_path and, with
+    echo, printed. The whole process tree is killed after timeout seconds.
+    Returns the exit code and the resources used by the command.
+    """
+    kwargs = {"start_new_session": True} if os.name == "posix" else {}
+    start = time.time()
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, env=env, **kwargs)
+    timed_out = []
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill_tree, (process, timed_out))
+        timer.daemon = True
+        timer.start()
+    log = open(log_path, "wb") if log_path else None
+    try:
+        for line in process.stdout:
+            if log is not None:
+                log.write(line)
+            text = line.decode("utf-8", "replace")
+            if echo:
+                sys.stdout.write(text)
+            if on_line is not None:
+                on_line(text)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if log is not None:
+            log.close()
+        process.stdout.close()
+
+    if hasattr(os, "wait4"):
+        # the usage of the shell includes the conan process and the compilers it waited for
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = _exit_code(status)
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        max_rss_kb = usage.ru_maxrss / 1024.0 if sys.platform == "darwin" else usage.ru_maxrss
+        return RunResult(process.returncode, bool(timed_out), time.time() - start,
+                         usage.ru_utime, usage.ru_stime, max_rss_kb)
+    process.wait()
+    return RunResult(process.returncode, bool(timed_out), time.time() - start, None, None, None)
@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+import tempfile
+
+recipe_folders = ["library", "consumer"]
+
+
+def relative_destination(path):
+    """ Path of a destination like ../library/src/mydetlib.cpp relative to the
+    staging folder, only the recipe folders can be staged
+    """
+    relative = os.path.normpath(os.path.relpath(path, ".."))
+    if relative.split(os.sep)[0] not in recipe_folders:
+        raise ValueError("{} is not inside a recipe folder".format(path))
+    return relative.replace(os.sep, "/")
+
+
+def manifest(recipe, sources):
+    """ Every input of a build: the files of the recipe and the sources of the
+    check, as a dict of staged path to the file it comes from
+    """
+    result = {}
+    for filename in recipe.files:
+        src = "{}/{}".format(recipe.folder, filename)
+        result[relative_destination(src)] = src
+    for src, dst in sources.items():
+        result[relative_destination(dst)] = src
+    return result
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        shutil.copy2(src, dst)
+
+
+class Staging(object):
+    """ Fresh folder with the inputs of a single build. The files are hard
+    linked from the repository when the filesystem allows it and copied
+    otherwise, the manifest is written next to the recipe folders.
+    """
+    def __init__(self, root, inputs):
+        self.root = root
+        self.manifest = inputs
+
+    @staticmethod
+    def create(recipe, sources):
+        inputs = manifest(recipe, sources)
+        staging = Staging(tempfile.mkdtemp(prefix="detstage_"), inputs)
+        for dst, src in sorted(inputs.items()):
+            dst = os.path.join(staging.root, dst)
+            if not os.path.exists(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            _link_or_copy(src, dst)
+        with open(os.path.join(staging.root, "manifest.json"), "w") as f:
+            json.dump(inputs, f, indent=4, sort_keys=True)
+        return staging
+
+    def resolve(self, path):
+        return os.path.join(self.root, relative_destination(path))
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors=True)